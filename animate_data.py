@@ -1,85 +1,91 @@
 #!/usr/bin/env python3
 
+from compiled_puzzle import load_puzzle
 from PIL import Image, ImageDraw, ImageFont
-import json, multiprocessing, os, random, shutil, subprocess, sys, time
+import collections, concurrent.futures, hashlib, heapq, json, multiprocessing, os, random, shutil, subprocess, sys, threading, time
+import numpy as np
 
 USE_NVENC = "ANIMATE_USE_NVENC" in os.environ
 VERIFY_SIZE = "ANIMATE_VERIFY_SIZE" in os.environ
 SECOND_FRAMES = "ANIMATE_SECOND_FRAMES" in os.environ
-OUTPUT_FN = None
-
-def clean_data(data):
-    # Normalize from different formats to a single format of data
-    for key in ['vertices', 'shapes', 'palettes']:
-        if key not in data and 'body' in data and key in data['body']:
-            data[key] = data['body'][key]
-    if 'palettes' in data and 'palette' not in data:
-        data['palette'] = data['palettes']
-    if isinstance(data["vertices"], list):
-        data["vertices"] = {str(i): x for i, x in enumerate(data["vertices"])}
-    if 'shapes' not in data['vertices']["0"]:
-        for vertex in data['vertices'].values():
-            vertex['shapes'] = []
-        for i, shape in enumerate(data['shapes']):
-            for vertex in shape['vertices']:
-                if i not in data['vertices'][str(vertex)]['shapes']:
-                    data['vertices'][str(vertex)]['shapes'].append(i)
-
-def show_puzzle(data, transparent=False, solid_color=None, appear=None, decay=None):
-    # Simple helper to decode a Vertex data dump into an image
-
-    # Run through all of the vertex points and figure out the size of the image
-    min_x, min_y, max_x, max_y = None, None, None, None
-    for key, value in data["vertices"].items():
-        x, y = value["coordinates"]
-        if min_x is None:
-            min_x, min_y, max_x, max_y = x, y, x, y
-        else:
-            min_x = min(min_x, x)
-            max_x = max(max_x, x)
-            min_y = min(min_y, y)
-            max_y = max(max_y, y)
-
-    # Scale everthing to a big image
-    width, height = 2000, 2000
-    length = max(max_x - min_x, max_y - min_y) * 1.1
-
-    # Draw each polygon in turn
-    im = Image.new('RGBA' if transparent else 'RGB', (width, height), (0,0,0,0) if transparent else (255, 255, 255))
-    dr = ImageDraw.Draw(im)
-
-    for i, c in enumerate(data["palette"]):
-        # Turn the #rrggbb or #rgb into a normal PIL color tuple
-        if len(c) == 4:
-            c = (int(c[1], 16) * 17, int(c[2], 16) * 17, int(c[3], 16) * 17) + ((255,) if transparent else tuple())
-        else:
-            c = (int(c[1:3], 16), int(c[3:5], 16), int(c[5:7], 16)) + ((255,) if transparent else tuple())
-        data['palette'][i] = c
+# Send the frames right to ffmpeg as raw video instead of a directory of PNG files
+STREAM_FRAMES = "ANIMATE_STREAM" in os.environ
+# Output presets, the size of the video and any extra ffmpeg arguments for
+# when it's not using NVENC, the small one is meant for quick checks
+PRESETS = {
+    "360p": ((640, 360), ['-preset', 'ultrafast']),
+    "720p": ((1280, 720), []),
+    "1080p": ((1920, 1080), []),
+    "4k": ((3840, 2160), []),
+}
+PRESET = os.environ.get("ANIMATE_PRESET", "1080p")
+FRAME_SIZE, PRESET_ARGS = PRESETS[PRESET]
+# Everything was laid out for a 2000 pixel render shrunk into a 1080p frame,
+# so the render and the text scale along with the frame
+RENDER_SIZE = round(2000 * FRAME_SIZE[1] / 1080)
+# The animation around each puzzle, in frames: the steps of the appear and
+# decay animations, and how long to hold before and after the solve
+APPEAR_STEPS = 30
+HOLD_START = 30
+HOLD_END = 60
+HOLD_END_SINGLE = 60 * 5
+# Bump this if the way frames are drawn changes, so frames left from an
+# earlier run aren't used again
+FRAME_VERSION = 1
+# Totals for each puzzle, so a run can be planned without solving every puzzle
+INDEX_FN = os.path.join("cache", "frame_index.json")
+# Bump this if the way the solve is planned changes
+PLAN_VERSION = 1
+# How many pieces to split a long video into, each encoded at the same time.
+# This is only for encoding on the CPU, NVENC cards only allow a few
+# encoders at once, so with NVENC every video is one piece
+SEGMENTS = int(os.environ.get("ANIMATE_SEGMENTS", str(max(1, (os.cpu_count() or 1) // 4))))
+# How many frame jobs can be handed to the workers at once, so planning
+# only runs a little ahead of drawing, 0 means four per worker
+WINDOW = int(os.environ.get("ANIMATE_WINDOW", "0"))
+# Append the numbers from each run to this file as JSON lines
+TELEMETRY_FN = os.environ.get("ANIMATE_TELEMETRY")
+# How many chunks make_chunks splits everything into, or if CHUNK_MINUTES
+# is set, about how long each chunk should be
+CHUNKS = int(os.environ.get("ANIMATE_CHUNKS", "15"))
+CHUNK_MINUTES = float(os.environ.get("ANIMATE_CHUNK_MINUTES", "0"))
+# How many chunks make_chunks draws at once, they all share the workers
+CHUNK_JOBS = int(os.environ.get("ANIMATE_CHUNK_JOBS", "2"))
+# How many days make_daily can have frames on disk for at once
+DAILY_DAYS = int(os.environ.get("ANIMATE_DAILY_DAYS", "4"))
+# How many days make_daily encodes at once, the workers drawing frames get
+# the rest of the CPUs
+DAILY_ENCODES = int(os.environ.get("ANIMATE_DAILY_ENCODES", "2"))
 
-    for shape in data["shapes"]:
-        if shape.get('isPreDrawn', False) or shape.get('sides', 0) > 0:
+def draw_shapes(dr, progress, projected, palette, line_width, solid_color=None, decay=None, only=None, offset=(0, 0)):
+    # Draw the shapes that are filled in, and the sides of the ones that
+    # are partly done.  progress is the number of sides drawn for each
+    # shape, or 4 if it's filled in.  If only is passed in, just those
+    # shapes are drawn, and everything is moved up and left by offset
+    colors = projected.puzzle.shape_colors
+    for shape_i in (progress.nonzero()[0].tolist() if only is None else only):
+        sides = int(progress[shape_i])
+        if sides > 0:
             # Only draw "pre drawn" shapes, or ones with partial sides
-            pts = []
-            for cur in shape["vertices"]:
-                x, y = data["vertices"][str(cur)]["coordinates"]
-                x = ((x - ((min_x + max_x) / 2)) / (length / 2)) * (width / 2) + (width / 2)
-                y = ((y - ((min_y + max_y) / 2)) / (length / 2)) * (height / 2) + (height / 2)
-                pts.append((x, y))
-            
+            pts = projected.shape_points[shape_i]
+
             if decay is not None:
-                center_x = sum(pt[0] for pt in pts) / len(pts)
-                center_y = sum(pt[1] for pt in pts) / len(pts)
+                pts = projected.shape_arrays[shape_i]
                 perc = (1 - (decay * 0.75))
-                pts = [(pt[0] * perc + center_x * (1 - perc), pt[1] * perc + center_y * (1 - perc)) for pt in pts]
+                pts = pts * perc + pts.mean(axis=0) * (1 - perc)
+                pts = [tuple(x) for x in pts.tolist()]
+
+            if offset != (0, 0):
+                pts = [(x - offset[0], y - offset[1]) for x, y in pts]
 
-            if not shape.get('isPreDrawn', False):
+            if sides < 4:
                 # This means we should just draw some of the sides, so do that
-                for i in range(shape.get('sides', 0)):
-                    dr.line((pts[i], pts[(i+1) % len(pts)]), (0, 0, 0), 2)
+                for i in range(sides):
+                    dr.line((pts[i], pts[(i+1) % len(pts)]), (0, 0, 0), line_width)
             else:
                 # Otherwise, draw the solid color
                 if solid_color is None:
-                    c = data["palette"][int(shape["color"])]
+                    c = palette[colors[shape_i]]
                     if decay is not None:
                         c = (int(c[0] * (1 - decay) + 255 * decay), int(c[1] * (1 - decay) + 255 * decay), int(c[2] * (1 - decay) + 255 * decay))
                 else:
@@ -87,21 +93,135 @@ def show_puzzle(data, transparent=False, solid_color=None, appear=None, decay=No
                 # Draw the polygon
                 dr.polygon(pts, c)
 
-    to_show = [x for x in data['vertices'].values() if x['hits'] > 0]
+def vertex_hits(puzzle, progress):
+    # The number of shapes left to fill in that use each vertex
+    left = np.repeat(progress < 4, np.diff(puzzle.shape_offsets))
+    return np.bincount(puzzle.shape_vertices[left], minlength=puzzle.vertex_count)
+
+# Vertex circles by the pixel size of their bounding box and line width
+_circle_sprites = {}
+def circle_sprite(width, height, line_width):
+    key = (width, height, line_width)
+    if key not in _circle_sprites:
+        sprite = Image.new('RGBA', (width + 1, height + 1), (0, 0, 0, 0))
+        ImageDraw.Draw(sprite).ellipse((0, 0, width, height), (255, 255, 255, 255), (0, 0, 0, 255), line_width)
+        _circle_sprites[key] = sprite
+    return _circle_sprites[key]
+
+def draw_vertices(im, hits, projected, scale, line_width, appear=None):
+    order = projected.puzzle.vertex_order
+    to_show = order[hits[order] > 0]
 
     if appear is not None:
-        to_show.sort(key=lambda x: x['coordinates'][0] ** 2 + x['coordinates'][1] ** 2)
+        coords = projected.puzzle.coords[to_show]
+        to_show = to_show[np.argsort(coords[:, 0] ** 2 + coords[:, 1] ** 2, kind='stable')]
         to_show = to_show[:int(len(to_show) * appear)]
 
-    # Run through and draw the circles for the vertix points
-    for vertex in to_show:
-        x, y = vertex["coordinates"]
-        x = ((x - ((min_x + max_x) / 2)) / (length / 2)) * (width / 2) + (width / 2)
-        y = ((y - ((min_y + max_y) / 2)) / (length / 2)) * (height / 2) + (height / 2)
-        dr.circle((x, y), vertex['hits'] + 4 * 2, (255,255,255), (0,0,0), 2)
+    # Run through and draw the circles for the vertix points.  PIL draws a
+    # circle from its bounding box rounded down to whole pixels, so the same
+    # sized box always gives the same pixels, and those can be pasted in
+    pts = projected.points[to_show]
+    radius = ((hits[to_show] + 4 * 2) * scale)[:, None]
+    top_left = np.floor(pts - radius).astype(np.int64)
+    bottom_right = np.floor(pts + radius).astype(np.int64)
+    for (x0, y0), (x1, y1) in zip(top_left.tolist(), bottom_right.tolist()):
+        sprite = circle_sprite(x1 - x0, y1 - y0, line_width)
+        im.paste(sprite, (x0, y0), sprite)
 
+def initial_progress(puzzle):
+    # The starting state of a puzzle, only the pre drawn shapes are filled in
+    return np.where(puzzle.shape_predrawn, 4, 0).astype(np.uint8)
+
+def show_puzzle(projected, progress=None, transparent=False, solid_color=None, appear=None, decay=None, vertices=True):
+    # Simple helper to draw a puzzle in a given state into an image, the
+    # projected puzzle is passed in so it's only calculated once for all the
+    # frames of a puzzle, and it sets the size of the image
+    width, height = projected.width, projected.height
+    im = Image.new('RGBA' if transparent else 'RGB', (width, height), (0,0,0,0) if transparent else (255, 255, 255))
+    draw_puzzle(im, projected, progress, transparent, solid_color, appear, decay, vertices)
     return im
 
+def draw_puzzle(im, projected, progress=None, transparent=False, solid_color=None, appear=None, decay=None, vertices=True):
+    # The same as show_puzzle, but draws on an image that's already cleared,
+    # so the caller can reuse one image for every frame
+    if progress is None:
+        progress = initial_progress(projected.puzzle)
+    # Lines and circles were sized for a 2000 pixel image
+    scale = projected.width / 2000
+    line_width = max(1, round(2 * scale))
+
+    # Draw each polygon in turn
+    dr = ImageDraw.Draw(im)
+
+    # The palette is already decoded in the compiled puzzle
+    palette = [tuple(x) + ((255,) if transparent else tuple()) for x in projected.puzzle.palette.tolist()]
+
+    draw_shapes(dr, progress, projected, palette, line_width, solid_color, decay)
+    if vertices:
+        draw_vertices(im, vertex_hits(projected.puzzle, progress), projected, scale, line_width, appear)
+
+class FrameRenderer:
+    # Keeps a canvas with the shapes of the puzzle that's being drawn, each
+    # frame only redraws the area around the shapes that changed since the
+    # last frame, and then the vertex circles go on a copy of that canvas.
+    # Frames for a puzzle need to come in order for this to help, if the
+    # puzzle changes or goes backwards the canvas is drawn from scratch.
+    # Both images are kept for the life of the worker and cleared in place,
+    # so the frame that's returned is only good till render is called again.
+    def __init__(self):
+        self.source = None
+        self.base = None
+        self.frame = None
+        self.progress = None
+        self.rebuilds = 0
+
+    def render(self, progress, projected, source, appear=None, decay=None):
+        size = projected.width
+        if self.frame is None or self.frame.width != size:
+            self.base = Image.new('RGB', (size, size), (255, 255, 255))
+            self.frame = Image.new('RGB', (size, size), (255, 255, 255))
+            self.source = None
+        if decay is not None:
+            # Every shape moves while decaying, nothing to reuse
+            self.frame.paste((255, 255, 255), (0, 0, size, size))
+            draw_puzzle(self.frame, projected, progress, appear=appear, decay=decay)
+            return self.frame
+
+        scale = size / 2000
+        line_width = max(1, round(2 * scale))
+
+        if self.source != source or (progress < self.progress).any():
+            self.base.paste((255, 255, 255), (0, 0, size, size))
+            draw_puzzle(self.base, projected, progress, vertices=False)
+            self.source = source
+            self.rebuilds += 1
+        else:
+            palette = [tuple(x) for x in projected.puzzle.palette.tolist()]
+            boxes = projected.shape_boxes
+            pad = line_width + 1
+            for shape_i in (progress != self.progress).nonzero()[0].tolist():
+                # Draw everything that touches this shape again on a patch,
+                # and use that to replace the area around this shape.  The
+                # patch is big enough to hold all of those shapes, since PIL
+                # draws polygons slightly differently if they're cut off
+                x0, y0, x1, y1 = boxes[shape_i].tolist()
+                x0, y0 = max(0, x0 - pad), max(0, y0 - pad)
+                x1, y1 = min(size, x1 + pad), min(size, y1 + pad)
+                touching = ((boxes[:, 0] - pad <= x1) & (boxes[:, 2] + pad >= x0) & (boxes[:, 1] - pad <= y1) & (boxes[:, 3] + pad >= y0)).nonzero()[0]
+                px0, py0 = boxes[touching, :2].min(axis=0).tolist()
+                px1, py1 = boxes[touching, 2:].max(axis=0).tolist()
+                px0, py0 = max(0, min(x0, px0 - pad)), max(0, min(y0, py0 - pad))
+                px1, py1 = min(size, max(x1, px1 + pad)), min(size, max(y1, py1 + pad))
+                patch = Image.new('RGB', (px1 - px0, py1 - py0), (255, 255, 255))
+                draw_shapes(ImageDraw.Draw(patch), progress, projected, palette, line_width, only=touching.tolist(), offset=(px0, py0))
+                self.base.paste(patch.crop((x0 - px0, y0 - py0, x1 - px0, y1 - py0)), (x0, y0))
+        self.progress = progress
+
+        # Copy the canvas over the last frame, rather than making a new image
+        self.frame.paste(self.base, (0, 0))
+        draw_vertices(self.frame, vertex_hits(projected.puzzle, progress), projected, scale, line_width, appear)
+        return self.frame
+
 def get_filenames(target):
     bail = -1
     if (isinstance(target, str) and target == "all") or isinstance(target, tuple):
@@ -114,7 +234,8 @@ def get_filenames(target):
                     dirs.append(cur)
                 else:
                     if isinstance(target, tuple):
-                        if target[0] <= fn <= target[1]:
+                        # Compare just the dates, so the last day is included
+                        if target[0][:10] <= fn[:10] <= target[1][:10]:
                             yield cur
                     else:
                         yield cur
@@ -124,192 +245,408 @@ def get_filenames(target):
     else:
         yield target
 
-def get_items(target, full_data=True):
+def solve_frames(unsolved):
+    # One frame for the starting state, then one for each side of each shape
+    return 1 + 4 * unsolved
+
+def puzzle_frames(entry, total_files):
+    # The total number of video frames for a puzzle, including the appear
+    # and decay animations and the holds around the solve
+    hold_end = HOLD_END_SINGLE if total_files == 1 else HOLD_END
+    return APPEAR_STEPS + HOLD_START + max(0, entry['solve_frames'] - 2) + hold_end + APPEAR_STEPS
+
+class FrameIndex:
+    # A cache of the totals for each puzzle, stored with the size and mtime
+    # of the source file so changed puzzles are picked up again
+    def __init__(self, fn=INDEX_FN):
+        self.fn = fn
+        self.entries = {}
+        self.dirty = False
+        if os.path.isfile(fn):
+            with open(fn) as f:
+                data = json.load(f)
+            if data.get("version") == PLAN_VERSION:
+                self.entries = data["puzzles"]
+
+    def get(self, fn):
+        stat = os.stat(fn)
+        key = [stat.st_mtime_ns, stat.st_size]
+        entry = self.entries.get(fn)
+        if entry is None or entry['key'] != key:
+            puzzle = load_puzzle(fn)
+            unsolved = int(puzzle.shape_count - puzzle.shape_predrawn.sum())
+            entry = {
+                "key": key,
+                "shapes": puzzle.shape_count,
+                "unsolved": unsolved,
+                "solve_frames": solve_frames(unsolved),
+            }
+            self.entries[fn] = entry
+            self.dirty = True
+        return entry
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.fn), exist_ok=True)
+        temp_fn = self.fn + f".{os.getpid()}.tmp"
+        with open(temp_fn, "wt", newline="", encoding="utf-8") as f:
+            json.dump({"version": PLAN_VERSION, "puzzles": self.entries}, f, indent=4, sort_keys=True)
+            f.write("\n")
+        os.replace(temp_fn, self.fn)
+        self.dirty = False
+
+def plan(target):
+    # The index entry for each puzzle in a run, in order
+    index = FrameIndex()
+    ret = [(fn, index.get(fn)) for fn in get_filenames(target)]
+    index.save()
+    return ret
+
+def solve_order(puzzle, rng=random):
+    # Walk through solving the puzzle one side at a time, yielding the
+    # progress of every shape for each frame, and if that frame finished a
+    # shape.  Work stays near the last shape: keep going on the current
+    # vertex, then the vertices touched most recently, and only then jump to
+    # the vertex used by the most shapes that are left.  Hit counts are kept
+    # up to date as shapes finish, and the busiest vertex comes from a heap
+    # where out of date entries are skipped when they get to the top.
+    progress = bytearray(initial_progress(puzzle).tobytes())
+    hits = vertex_hits(puzzle, np.frombuffer(progress, dtype=np.uint8)).tolist()
+    shape_vertices = [puzzle.shape(i).tolist() for i in range(puzzle.shape_count)]
+    vertex_shapes = [puzzle.vertex_shapes_of(i).tolist() for i in range(puzzle.vertex_count)]
+    # Ties go to the vertex that comes last in the file
+    position = [0] * puzzle.vertex_count
+    for i, vertex in enumerate(puzzle.vertex_order.tolist()):
+        position[vertex] = i
+    busiest = [(-hits[x], -position[x], x) for x in range(puzzle.vertex_count) if hits[x] > 0]
+    heapq.heapify(busiest)
+
+    # The first frame is the puzzle before anything is done
+    yield bytes(progress), False
+
+    cur_vertex = None
+    # Vertices we've touched, these are next to use
+    vertices_to_use = []
+    touched = set()
+    while True:
+        # Figure out the shape to draw
+        while True:
+            if cur_vertex is not None:
+                # Ok, we've already picked a vertex to work on, find the next shape to work on
+                to_pick = [x for x in vertex_shapes[cur_vertex] if progress[x] < 4]
+                if len(to_pick) > 0:
+                    break
+                # There are no shapes left for this vertex
+                cur_vertex = None
+            while len(vertices_to_use) > 0:
+                # We've touched some other vertex, so use the next one
+                vertex = vertices_to_use.pop(-1)
+                touched.discard(vertex)
+                if hits[vertex] > 0:
+                    cur_vertex = vertex
+                    break
+            if cur_vertex is None:
+                # Nothing left we've touched, just find something else
+                while len(busiest) > 0 and -busiest[0][0] != hits[busiest[0][2]]:
+                    heapq.heappop(busiest)
+                if len(busiest) == 0:
+                    # All done doing all the things
+                    return
+                cur_vertex = busiest[0][2]
+        # Finally, pick a shape, just pick at random
+        cur_shape = rng.choice(to_pick)
+
+        for vertex in shape_vertices[cur_shape]:
+            if vertex not in touched:
+                touched.add(vertex)
+                vertices_to_use.append(vertex)
+        # Show an edge at a time till we've shown them all
+        for sides in range(1, 4):
+            progress[cur_shape] = sides
+            yield bytes(progress), False
+        # All sides shown, just draw this shape
+        progress[cur_shape] = 4
+        for vertex in shape_vertices[cur_shape]:
+            hits[vertex] -= 1
+        for vertex in set(shape_vertices[cur_shape]):
+            if hits[vertex] > 0:
+                heapq.heappush(busiest, (-hits[vertex], -position[vertex], vertex))
+        yield bytes(progress), True
+
+def frame_key(puzzle, fn, i):
+    # Everything that changes how a frame looks: the puzzle, where the frame
+    # is in the puzzle's animation, the date that's shown, and the size
+    date = fn.replace("\\", "/").split("/")[-1][:10]
+    return hashlib.sha1(json.dumps([FRAME_VERSION, puzzle.content_hash, i, date, PRESET, RENDER_SIZE]).encode("utf-8")).hexdigest()
+
+def frame_filename(job):
+    return f"frame_{job['key']}.png"
+
+def get_items(target):
     # Load data
     frame_no = 0
-    left = 0
-    files_left = 0
-    total_files = 0
+    puzzles = plan(target)
+    left = sum(entry['unsolved'] for fn, entry in puzzles)
+    files_left = len(puzzles)
+    total_files = len(puzzles)
 
-    for fn in get_filenames(target):
-        with open(fn) as f:
-            data = json.load(f)
-        clean_data(data)
-        left += sum(1 for x in data['shapes'] if not x.get('isPreDrawn', False))
-        files_left += 1
-        total_files += 1
-
-    for fn in get_filenames(target):
+    for fn, entry in puzzles:
         files_left -= 1
-        with open(fn) as f:
-            data = json.load(f)
-        clean_data(data)
-
-        # Build up a list of frames to draw
-        cur_vertex = None
-        cur_shape = None
+        # Build up a list of frames to draw, the shapes are picked at random
+        # but seeded from the puzzle, so a puzzle is always drawn the same way
+        puzzle = load_puzzle(fn)
         todo = []
-        first = True
-        # Vertices we've touched, these are next to use
-        vertices_to_use = []
-        while True:
-            if cur_shape is None:
-                if not first:
-                    # Figure out the shape to draw, after the first frame
-                    while True:
-                        if cur_vertex is not None:
-                            # Ok, we've already picked a vertex to work on, find the next shape to work on
-                            to_pick = [data['shapes'][int(x)] for x in cur_vertex['shapes'] if not data['shapes'][int(x)].get('isPreDrawn', False)]
-                            if len(to_pick) == 0:
-                                # There are no shapes left for this vertex
-                                cur_vertex = None
-                            else:
-                                # We found something to do, break out of this loop
-                                break
-                        if cur_vertex is None:
-                            # We finished our current vertex (or the first time), so find the next biggest vertex
-                            while len(vertices_to_use) > 0:
-                                # We've touched some other vertex, so use the next one
-                                cur_vertex = data['vertices'][vertices_to_use.pop(-1)]
-                                if cur_vertex['hits'] > 0:
-                                    break
-                                cur_vertex = None
-                        if cur_vertex is None:
-                            # Nothing left we've touched, just find something else
-                            temp = list(data['vertices'].values())
-                            temp.sort(key=lambda x:x['hits'])
-                            cur_vertex = temp[-1]
-                            if cur_vertex['hits'] == 0:
-                                break
-                    if len(to_pick) == 0:
-                        # All done doing all the things
-                        break
-                    # Finally, pick a shape, just pick at random
-                    cur_shape = random.choice(to_pick)
-                else:
-                    first = False
-
-            if cur_shape is not None:
-                for vertex in cur_shape['vertices']:
-                    if str(vertex) not in vertices_to_use:
-                        vertices_to_use.append(str(vertex))
-                # When we're working on a shape, show an edge till we've shown them all
-                cur_shape['sides'] = cur_shape.get('sides', 0) + 1
-                if cur_shape['sides'] == 4:
-                    # All sides shown, just draw this shape
-                    cur_shape['isPreDrawn'] = True
-                    cur_shape = None
-                    left -= 1
-
-            # Note the number of hits for each vertex that are left
-            for vertex in data['vertices'].values():
-                vertex['hits'] = 0
-
-            for shape in data["shapes"]:
-                if not shape.get('isPreDrawn', False):
-                    for cur in shape["vertices"]:
-                        data["vertices"][str(cur)]["hits"] += 1
-
-            # Save this frame as something to do, using json.dumps here as a simple deep-copy
-            if full_data:
-                todo.append({"source": fn, "left": left, "data": json.dumps(data), "frames": 1, "files_left": files_left})
-            else:
-                todo.append({"source": fn, "left": left, "frames": 1, "files_left": files_left})
+        for progress, finished in solve_order(puzzle, random.Random(puzzle.content_hash)):
+            if finished:
+                left -= 1
+            # Save this frame as something to do, the state is just how far
+            # along each shape is, the workers have the rest of the puzzle
+            todo.append({"source": fn, "left": left, "progress": progress, "frames": 1, "files_left": files_left})
 
         # Add a little animation on the first and last state
         temp = []
-        for i in range(31):
+        for i in range(APPEAR_STEPS + 1):
             temp.append(todo[0].copy())
-            temp[-1]['appear'] = i / 30
+            temp[-1]['appear'] = i / APPEAR_STEPS
             temp[-1]['type'] = i
         # Hold on the state before drawing for 0.5 seconds
-        temp[-1]['frames'] = 30
+        temp[-1]['frames'] = HOLD_START
 
         temp.extend(todo[1:-1])
-        for i in range(31):
+        for i in range(APPEAR_STEPS + 1):
             temp.append(todo[-1].copy())
-            temp[-1]['decay'] = i / 30
+            temp[-1]['decay'] = i / APPEAR_STEPS
             if i == 0:
                 if total_files == 1:
                     # Hold on the state when we're done for 5.0 seconds
-                    temp[-1]['frames'] = 60 * 5
+                    temp[-1]['frames'] = HOLD_END_SINGLE
                 else:
                     # Hold on the state when we're done for 1.0 seconds
-                    temp[-1]['frames'] = 60
+                    temp[-1]['frames'] = HOLD_END
             else:
-                temp[-1]['type'] = 30 - i
+                temp[-1]['type'] = APPEAR_STEPS - i
         todo = temp
 
         # Fill out the frame numbers
-        for cur in todo:
+        for i, cur in enumerate(todo):
+            cur['key'] = frame_key(puzzle, fn, i)
             cur['frame_no'] = frame_no
             frame_no += cur['frames']
             yield cur
         yield frame_no
 
-def make_daily():
-    global OUTPUT_FN
+def daily_filename():
+    # Drafts at other sizes are tracked on their own, so they're never
+    # taken for the real videos, or uploaded
+    return os.path.join("output", "daily" + preset_suffix() + ".json")
+
+def save_daily(data):
+    with open(daily_filename(), "wt", newline="", encoding="utf-8") as f:
+        json.dump(data, f, indent=4, sort_keys=True)
+        f.write("\n")
+    if PRESET != "1080p":
+        return
+    with open(os.path.join("images", "youtube.jsonl"), "wt", encoding="utf-8", newline="") as f:
+        for key, value in data.items():
+            if 'youtube' in value:
+                f.write(json.dumps([key, value['youtube'], value['theme']]) + "\n")
 
-    data_fn = os.path.join("output", "daily.json")
+def make_daily():
+    # Make a video for each day.  One pool of workers is kept busy drawing
+    # frames for several days at once, each day in its own directory, while
+    # the days that are done drawing are encoded alongside.  Each day is
+    # saved to daily.json as its video is finished, so this can be stopped
+    # with abort.txt (which lets the days in progress finish) and started
+    # again to pick up where it left off.
+    data_fn = daily_filename()
     if os.path.isfile(data_fn):
         with open(data_fn) as f:
             data = json.load(f)
     else:
         data = {}
-        
+
+    todo = []
     for fn in get_filenames("all"):
-        if os.path.isfile("abort.txt"):
-            break
         at = fn.replace("\\", "/").split("/")[-1][:10]
         if at not in data:
-            target_dir = os.path.join("output", at[:4], at[5:7])
-            if not os.path.isdir(target_dir):
-                os.makedirs(target_dir)
-            target_file = os.path.join(target_dir, at + ".mp4")
-            OUTPUT_FN = target_file
+            todo.append((at, fn))
 
-            print(f"Creating {at}...")
-            sys.argv = sys.argv[0:1] + [fn]
-            main()
+    for dn in ["frames", "output"] + (["frames2"] if SECOND_FRAMES else []):
+        if not os.path.isdir(dn):
+            os.mkdir(dn)
 
-            with open(fn) as f:
-                temp = json.load(f)
-            data[at] = {"at": at, "video": "/".join([at[:4], at[5:7], at + ".mp4"]), "theme": temp['theme']}
-            with open(data_fn, "wt", newline="", encoding="utf-8") as f:
-                json.dump(data, f, indent=4, sort_keys=True)
-                f.write("\n")
-            with open(os.path.join("images", "youtube.jsonl"), "wt", encoding="utf-8", newline="") as f:
-                for key, value in data.items():
-                    if 'youtube' in value:
-                        f.write(json.dumps([key, value['youtube'], value['theme']]) + "\n")
+    index = FrameIndex()
+    telemetry = Telemetry("daily", sum(puzzle_frames(index.get(fn), 1) for at, fn in todo))
+    index.save()
+
+    global _second_offset
+    drawing, to_encode, encoding = [], [], []
+    occasional = OccasionalMessage(5)
+    with multiprocessing.Pool(max(1, (os.cpu_count() or 1) - DAILY_ENCODES), initializer=set_offset, initargs=(_second_offset,)) as pool:
+        while True:
+            # Start drawing more days, as long as there's room on disk for them
+            while len(todo) > 0 and len(drawing) + len(to_encode) + len(encoding) < DAILY_DAYS and not os.path.isfile("abort.txt"):
+                at, fn = todo.pop(0)
+                # Any frames left from a run that was stopped are used again
+                frames_dir = os.path.join("frames", at)
+                os.makedirs(frames_dir, exist_ok=True)
+                jobs = []
+                for job in get_items(fn):
+                    if isinstance(job, int):
+                        new_frames = job
+                    else:
+                        job['frames_dir'] = frames_dir
+                        job['second_offset'] = _second_offset
+                        jobs.append(job)
+                entries = [(frame_filename(x), x['frames']) for x in jobs]
+                if SECOND_FRAMES:
+                    add_second_entries((f"frame_{x['frame_no'] + _second_offset:08d}.png", x['frames']) for x in jobs)
+                _second_offset += new_frames
+                print(f"Drawing {at}, {len(jobs):,} frames...")
+                drawing.append((at, fn, frames_dir, entries, pool.map_async(worker, jobs, chunksize=1)))
+
+            # Days that are drawn are ready to encode
+            for cur in [x for x in drawing if x[4].ready()]:
+                drawing.remove(cur)
+                # This raises any error from the workers
+                for result in cur[4].get():
+                    if isinstance(result, dict):
+                        telemetry.frame_done(result)
+                to_encode.append(cur[:4])
+
+            # Start encoding days, as long as there's CPU for them
+            while len(to_encode) > 0 and len(encoding) < DAILY_ENCODES:
+                at, fn, frames_dir, entries = to_encode.pop(0)
+                target_dir = os.path.join("output", at[:4], at[5:7])
+                if not os.path.isdir(target_dir):
+                    os.makedirs(target_dir)
+                concat_fn = os.path.join(frames_dir, "frames.ffconcat")
+                write_concat(concat_fn, entries)
+                cmd = ffmpeg_command(os.path.join(target_dir, at + preset_suffix() + ".mp4"), [
+                    '-loglevel', 'error', 
+                    '-f', 'concat', 
+                    '-safe', '0', 
+                    '-i', concat_fn, 
+                    '-fps_mode', 'vfr', 
+                ])
+                print(f"Encoding {at}...")
+                encoding.append((at, fn, frames_dir, entries, cmd, time.time(), subprocess.Popen(cmd)))
+
+            # Note the days that are done
+            for cur in [x for x in encoding if x[-1].poll() is not None]:
+                encoding.remove(cur)
+                at, fn, frames_dir, entries, cmd, started, proc = cur
+                if proc.returncode != 0:
+                    raise subprocess.CalledProcessError(proc.returncode, cmd)
+                telemetry.encoded(sum(x[1] for x in entries), time.time() - started, cmd[-1])
+                shutil.rmtree(frames_dir)
+                data[at] = {"at": at, "video": "/".join([at[:4], at[5:7], at + preset_suffix() + ".mp4"]), "theme": load_puzzle(fn).theme}
+                save_daily(data)
+                print(f"Done with {at}, {len(todo):,} days left")
+
+            if len(drawing) + len(to_encode) + len(encoding) == 0:
+                telemetry.report()
+                telemetry.done()
+                break
+            occasional(f"Drawing {len(drawing)}, waiting on {len(to_encode)}, encoding {len(encoding)}, {len(todo):,} days left")
+            time.sleep(0.1)
+
+def plan_chunks():
+    # Split every puzzle into CHUNKS runs of about the same length of video,
+    # or into runs of about CHUNK_MINUTES each if that's set.  Returns the
+    # first and last date of each run.
+    puzzles = plan("all")
+    frames = [puzzle_frames(entry, len(puzzles)) for fn, entry in puzzles]
+    total = sum(frames)
+    count = CHUNKS
+    if CHUNK_MINUTES > 0:
+        count = max(1, round(total / (CHUNK_MINUTES * 60 * 60)))
+    date = lambda fn: fn.replace("\\", "/").split("/")[-1][:10]
+
+    chunks = []
+    first, done = None, 0
+    for (fn, entry), cur in zip(puzzles, frames):
+        if first is not None and done >= total * (len(chunks) + 1) / count:
+            chunks.append((first, last, frames_in))
+            first = None
+        if first is None:
+            first, frames_in = date(fn), 0
+        last = date(fn)
+        frames_in += cur
+        done += cur
+    if first is not None:
+        chunks.append((first, last, frames_in))
+    return chunks
 
 def make_chunks():
-    chunks = [
-        ["2019-01-01", "2019-12-31"],
-        ["2020-01-01", "2020-05-31"],
-        ["2020-06-01", "2020-12-31"],
-        ["2021-01-01", "2021-12-31"],
-        ["2022-01-01", "2022-03-31"],
-        ["2022-04-01", "2022-06-30"],
-        ["2022-07-01", "2022-09-30"],
-        ["2022-10-01", "2022-12-31"],
-        ["2023-01-01", "2023-03-31"],
-        ["2023-04-01", "2023-06-30"],
-        ["2023-07-01", "2023-09-30"],
-        ["2023-10-01", "2023-12-31"],
-        ["2024-01-01", "2024-03-31"],
-        ["2024-04-01", "2024-06-30"],
-        ["2024-07-01", "2024-09-30"],
-    ]
-    for target in chunks:
-        sys.argv = sys.argv[0:1] + target
-        main()
+    # Draw the chunks at the same time, sharing one pool of workers, with
+    # each chunk in its own directory of frames
+    chunks = plan_chunks()
+    for first, last, frames in chunks:
+        frames //= 60
+        print(f"{first} to {last}: {frames//3600}:{(frames%3600)//60:02d}:{frames%60:02d}")
+
+    for dn in ["frames", "output"] + (["frames2"] if SECOND_FRAMES else []):
+        if not os.path.isdir(dn):
+            os.mkdir(dn)
+
+    def make_chunk(target, pool, second_offset):
+        frames_dir = os.path.join("frames", f"chunk_{target[0]}_{target[1]}")
+        os.makedirs(frames_dir, exist_ok=True)
+        make_video(target, frames_dir, pool, second_offset, max(1, SEGMENTS // CHUNK_JOBS))
+        shutil.rmtree(frames_dir)
+
+    global _second_offset
+    with multiprocessing.Pool(os.cpu_count() or 1) as pool:
+        with concurrent.futures.ThreadPoolExecutor(CHUNK_JOBS) as executor:
+            running = []
+            for first, last, frames in chunks:
+                running.append(executor.submit(make_chunk, (first, last), pool, _second_offset))
+                puzzles = plan((first, last))
+                _second_offset += sum(puzzle_frames(entry, len(puzzles)) for fn, entry in puzzles)
+            for cur in running:
+                # Raise any errors from the chunks
+                cur.result()
 
 _second_offset = 0
+# Every frame written to frames2 so far, as (filename, frames)
+_second_entries = []
+_second_lock = threading.Lock()
+def add_second_entries(entries):
+    # Videos can finish out of order when make_chunks draws them at the
+    # same time, but the names are numbered, so sort them back in order
+    with _second_lock:
+        _second_entries.extend(entries)
+        _second_entries.sort()
+        write_concat(os.path.join("frames2", "frames.ffconcat"), _second_entries)
 def set_offset(val):
     global _second_offset
     _second_offset = val
 
+class JobWindow:
+    # Hands jobs to the pool, but only keeps so many of them waiting at once.
+    # Pool.imap reads everything it's given as fast as it can, this only
+    # pulls the next job from the generator when one finishes.  Results
+    # come back in the same order the jobs went in.
+    def __init__(self, pool, func, size):
+        self.pool = pool
+        self.func = func
+        self.size = max(1, size)
+        self.pending = collections.deque()
+
+    @property
+    def depth(self):
+        return len(self.pending)
+
+    def run(self, items):
+        for item in items:
+            self.pending.append(self.pool.apply_async(self.func, (item,)))
+            while len(self.pending) >= self.size:
+                yield self.pending.popleft().get()
+        while len(self.pending) > 0:
+            yield self.pending.popleft().get()
+
 class OccasionalMessage:
     def __init__(self, delay=0.5):
         self.delay = delay
@@ -321,6 +658,87 @@ class OccasionalMessage:
                 self.next_msg += self.delay
             print(value)
 
+class Telemetry:
+    # Keeps track of how a run is going: frames per second, how long each
+    # step in the workers takes, how often they redraw the whole canvas,
+    # how fast jobs are planned, and how fast ffmpeg encodes.  Every so often a short status line is printed, and
+    # if ANIMATE_TELEMETRY is set to a filename, the same numbers, along
+    # with the start and end of each encode, are added to it as JSON lines.
+    def __init__(self, name, total_frames, delay=1):
+        self.name = name
+        self.total_frames = total_frames
+        self.delay = delay
+        self.started = time.time()
+        self.next_msg = self.started + delay
+        self.frames = 0
+        self.jobs = 0
+        # How many frames the workers had to draw the whole canvas for,
+        # instead of only the shapes that changed
+        self.rebuilds = 0
+        self.files_left = None
+        # Totals since the last status line
+        self.stages = {}
+        self.stage_jobs = 0
+        self.plan_seconds = 0
+        self.planned = 0
+        self.log("start", total_frames=total_frames)
+
+    def log(self, event, **values):
+        if TELEMETRY_FN is None:
+            return
+        with open(TELEMETRY_FN, "at", newline="", encoding="utf-8") as f:
+            f.write(json.dumps(dict({"event": event, "name": self.name, "at": round(time.time(), 3)}, **values)) + "\n")
+
+    def planned_job(self, seconds):
+        self.plan_seconds += seconds
+        self.planned += 1
+
+    def frame_done(self, result, depth=0):
+        self.frames += result['frames']
+        self.jobs += 1
+        self.rebuilds += result.get('rebuilds', 0)
+        self.files_left = result['files_left']
+        for key, value in result['timings'].items():
+            self.stages[key] = self.stages.get(key, 0) + value
+        self.stage_jobs += 1
+        if time.time() >= self.next_msg:
+            self.report(depth)
+
+    def report(self, depth=0):
+        now = time.time()
+        while now >= self.next_msg:
+            self.next_msg += self.delay
+        elapsed = max(now - self.started, 0.001)
+        fps = self.frames / elapsed
+        eta = int((self.total_frames - self.frames) / fps) if fps > 0 else 0
+        stages = {key: value / max(1, self.stage_jobs) for key, value in self.stages.items()}
+        plan_rate = self.planned / self.plan_seconds if self.plan_seconds > 0 else 0
+        self.log("progress", frames=self.frames, jobs=self.jobs, rebuilds=self.rebuilds, fps=round(fps, 2), eta=eta, 
+            queued=depth, plan_rate=round(plan_rate, 1), stages={key: round(value, 5) for key, value in stages.items()})
+        msg = f"{self.frames / max(1, self.total_frames):6.1%} {self.frames:,}/{self.total_frames:,} frames, {fps:.1f} fps, "
+        msg += f"ETA {eta // 3600}:{(eta % 3600) // 60:02d}:{eta % 60:02d}, {depth:,} queued"
+        if self.files_left is not None:
+            msg += f", {self.files_left:,} files left"
+        if len(stages) > 0:
+            msg += " | " + " ".join(f"{key} {value * 1000:.0f}ms" for key, value in stages.items())
+        if self.planned > 0:
+            msg += f" | plan {plan_rate:,.0f} jobs/s"
+        print(msg)
+        self.stages = {}
+        self.stage_jobs = 0
+        self.plan_seconds = 0
+        self.planned = 0
+
+    def encoded(self, frames, seconds, output_fn):
+        # ffmpeg's speed, in frames of video per second
+        speed = frames / max(seconds, 0.001)
+        self.log("encode", frames=frames, seconds=round(seconds, 3), fps=round(speed, 2), output=output_fn)
+        print(f"Encoded {output_fn}, {frames:,} frames in {seconds:.1f} seconds, {speed:.1f} fps")
+
+    def done(self):
+        seconds = time.time() - self.started
+        self.log("done", frames=self.frames, jobs=self.jobs, rebuilds=self.rebuilds, seconds=round(seconds, 3))
+
 def main():
     if len(sys.argv) == 3:
         target = (sys.argv[1], sys.argv[2])
@@ -342,14 +760,14 @@ def main():
         print("Usage: ")
         print("  <filename> = Animate a specific file")
         print("  all        = Animate all files to one video")
-        print("  chunks     = Make predefined chunks")
+        print("  chunks     = Split everything into chunks of about the same length")
         print("  daily      = Create an animation for each day")
         exit(0)
 
     if VERIFY_SIZE:
-        counts = [x for x in get_items(target, full_data=False) if isinstance(x, dict)]
-        total_days = len(set(x['source'] for x in counts))
-        frames = sum(x['frames'] for x in counts)
+        puzzles = plan(target)
+        total_days = len(puzzles)
+        frames = sum(puzzle_frames(entry, len(puzzles)) for fn, entry in puzzles)
         frames = frames // 60
         print(f"This will make a video of {frames//3600}:{(frames%3600)//60:02d}:{frames%60:02d} long for {total_days} days.")
         yn = input("Continue? [y/(n)] ")
@@ -360,28 +778,211 @@ def main():
         if not os.path.isdir(dn):
             os.mkdir(dn)
 
-    for cur in os.listdir("frames"):
-        os.unlink(os.path.join("frames", cur))
+    make_video(target)
+
+def make_video(target, frames_dir="frames", pool=None, second_offset=None, segments=SEGMENTS):
+    # Draw and encode the video for a target.  The frames go in frames_dir,
+    # and if a pool is passed in it's shared with whatever else is using it.
+    # Frames in frames2 start at second_offset, or where the last video in
+    # this process left off.
+    global _second_offset
+    if pool is None:
+        with multiprocessing.Pool(os.cpu_count() or 1, initializer=set_offset, initargs=(_second_offset,)) as pool:
+            return make_video(target, frames_dir, pool, second_offset, segments)
+
+    puzzles = plan(target)
+    total_frames = sum(puzzle_frames(entry, len(puzzles)) for fn, entry in puzzles)
+    telemetry = Telemetry(output_filename(target), total_frames)
+
+    if second_offset is None:
+        second_offset = _second_offset
+        _second_offset += total_frames
+
+    if STREAM_FRAMES:
+        # ffmpeg reads raw frames from a pipe, so start it first.  It writes
+        # to a temp file, so a run that fails never replaces a good video
+        stream_fn = os.path.splitext(output_filename(target))[0] + ".tmp.mp4"
+        cmd = ffmpeg_command(stream_fn, [
+            '-f', 'rawvideo', '-pixel_format', 'rgb24',
+            '-video_size', f"{FRAME_SIZE[0]}x{FRAME_SIZE[1]}",
+            '-framerate', '60', '-i', '-',
+        ])
+        print("$ " + " ".join(cmd))
+        encoder = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        stream = FrameStream(encoder.stdin)
+
+    # Note how long each frame is shown as it's handed off
+    entries = []
+    frame_numbers = []
+    # The index in entries of the first frame of each puzzle
+    starts = []
+    def track(items):
+        while True:
+            started = time.perf_counter()
+            job = next(items, None)
+            if job is None:
+                return
+            telemetry.planned_job(time.perf_counter() - started)
+            if isinstance(job, dict):
+                if len(starts) == 0 or entries[starts[-1]][2] != job['source']:
+                    starts.append(len(entries))
+                entries.append((frame_filename(job), job['frames'], job['source']))
+                frame_numbers.append((job['frame_no'], job['frames']))
+                job['stream'] = STREAM_FRAMES
+                job['frames_dir'] = frames_dir
+                job['second_offset'] = second_offset
+            yield job
 
     # Spin off to the workers to do the work
-    occasional = OccasionalMessage(1)
     new_frames = 0
-    global _second_offset
-    with multiprocessing.Pool(initializer=set_offset, initargs=(_second_offset,)) as pool:
-        for msg in pool.imap_unordered(worker, get_items(target)):
-            if isinstance(msg, int):
-                new_frames = msg
+    window = JobWindow(pool, worker, WINDOW if WINDOW > 0 else (os.cpu_count() or 1) * 4)
+    try:
+        for result in window.run(track(get_items(target))):
+            if isinstance(result, int):
+                new_frames = result
             else:
-                occasional(msg)
+                if STREAM_FRAMES:
+                    stream.add(result['frame_no'], result['frames'], result['bits'])
+                telemetry.frame_done(result, window.depth)
+    except:
+        # Don't let ffmpeg finish off a video that's missing frames
+        if STREAM_FRAMES:
+            encoder.kill()
+            encoder.wait()
+            if os.path.isfile(stream_fn):
+                os.unlink(stream_fn)
+        raise
+    telemetry.report()
 
-    _second_offset += new_frames
+    # Frames are named by what's in them, so ones left from a run that was
+    # stopped are used again.  Now that every frame is there, anything else
+    # is from some other run.  (This leaves the directories of any days
+    # make_daily is working on.)
+    keep = set(x[0] for x in entries)
+    for cur in os.listdir(frames_dir):
+        if cur not in keep and os.path.isfile(os.path.join(frames_dir, cur)):
+            os.unlink(os.path.join(frames_dir, cur))
 
+    if SECOND_FRAMES:
+        add_second_entries((f"frame_{frame_no + second_offset:08d}.png", frames) for frame_no, frames in frame_numbers)
+
+    if STREAM_FRAMES:
+        # ffmpeg was encoding the whole time, so its speed is the whole run
+        encoder.stdin.close()
+        if encoder.wait() != 0:
+            raise subprocess.CalledProcessError(encoder.returncode, cmd)
+        os.replace(stream_fn, output_filename(target))
+        telemetry.encoded(new_frames, time.time() - telemetry.started, output_filename(target))
+        telemetry.done()
+        return
+
+    # Each frame was only drawn once, the list tells ffmpeg how long to show it
+    encode_started = time.time()
+    segments = split_segments(entries, starts, 1 if USE_NVENC else segments)
+    if len(segments) == 1:
+        concat_fn = os.path.join(frames_dir, "frames.ffconcat")
+        write_concat(concat_fn, entries)
+        cmd = ffmpeg_command(output_filename(target), [
+            '-f', 'concat', 
+            '-safe', '0', 
+            '-i', concat_fn, 
+            '-fps_mode', 'vfr', 
+        ])
+        print("$ " + " ".join(cmd))
+        subprocess.check_call(cmd)
+        telemetry.encoded(new_frames, time.time() - encode_started, output_filename(target))
+        telemetry.done()
+        return
+
+    # A long video is encoded in pieces at the same time, each piece starts
+    # on a new puzzle, and then the pieces are joined without encoding again.
+    # Only the last piece repeats its last frame, the others would end with
+    # an extra still at every join
+    encoders = []
+    for i, segment in enumerate(segments):
+        concat_fn = os.path.join(frames_dir, f"segment_{i:04d}.ffconcat")
+        write_concat(concat_fn, segment, i == len(segments) - 1)
+        cmd = ffmpeg_command(os.path.join(frames_dir, f"segment_{i:04d}.mp4"), [
+            '-loglevel', 'error', 
+            '-f', 'concat', 
+            '-safe', '0', 
+            '-i', concat_fn, 
+            '-fps_mode', 'vfr', 
+        ])
+        print("$ " + " ".join(cmd))
+        encoders.append((cmd, subprocess.Popen(cmd)))
+    for cmd, proc in encoders:
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    concat_fn = os.path.join(frames_dir, "segments.ffconcat")
+    with open(concat_fn, "wt", newline="", encoding="utf-8") as f:
+        f.write("ffconcat version 1.0\n")
+        for i, segment in enumerate(segments):
+            # Without its repeated frame, a piece doesn't say how long its
+            # last frame is on screen, so give each one its planned length
+            # and the next piece starts right where it should
+            f.write(f"file segment_{i:04d}.mp4\n")
+            f.write(f"duration {sum(x[1] for x in segment) / 60:.6f}\n")
     cmd = [
         'ffmpeg', 
         "-y", "-hide_banner", 
-        '-framerate', '60', 
-        '-i', os.path.join('frames', 'frame_%08d.png'), 
+        '-f', 'concat', 
+        '-i', concat_fn, 
+        '-c', 'copy', 
+        output_filename(target), 
     ]
+    print("$ " + " ".join(cmd))
+    subprocess.check_call(cmd)
+    telemetry.encoded(new_frames, time.time() - encode_started, output_filename(target))
+    telemetry.done()
+
+def split_segments(entries, starts, count):
+    # Split the frames into up to count runs with about the same number of
+    # frames in each, only cutting where a puzzle starts
+    total = sum(x[1] for x in entries)
+    cuts = [0]
+    frames = 0
+    for i, start in enumerate(starts):
+        if start > 0 and frames >= total * len(cuts) / count:
+            cuts.append(start)
+        end = starts[i + 1] if i + 1 < len(starts) else len(entries)
+        frames += sum(x[1] for x in entries[start:end])
+    cuts.append(len(entries))
+    return [entries[a:b] for a, b in zip(cuts, cuts[1:])]
+
+def write_concat(fn, entries, repeat_last=True):
+    # Write out a list of frames for ffmpeg's concat demuxer, with how long
+    # each one is on screen.  The last frame is listed twice, otherwise
+    # ffmpeg doesn't use its duration, unless something else will follow it.
+    # Each image is opened at 60 fps, at the default of 25 fps frames shown
+    # for 1/60 of a second land on the same timestamp and get dropped.  The
+    # option lines need ffmpeg to be run with -safe 0
+    with open(fn, "wt", newline="", encoding="utf-8") as f:
+        f.write("ffconcat version 1.0\n")
+        for filename, frames, *_ in entries:
+            f.write(f"file {filename}\n")
+            f.write("option framerate 60\n")
+            f.write(f"duration {frames / 60:.6f}\n")
+        if repeat_last and len(entries) > 0:
+            f.write(f"file {entries[-1][0]}\n")
+            f.write("option framerate 60\n")
+
+def preset_suffix():
+    # Anything other than the normal size gets the preset in the name
+    return "" if PRESET == "1080p" else "_" + PRESET
+
+def output_filename(target):
+    suffix = preset_suffix()
+    if isinstance(target, tuple):
+        return os.path.join("output", "vertex_" + target[0] + "_" + target[1] + suffix + ".mp4")
+    return os.path.join("output", "vertex_" + target.replace("\\", "/").split("/")[-1] + suffix + ".mp4")
+
+def ffmpeg_command(output_fn, input_args):
+    cmd = [
+        'ffmpeg', 
+        "-y", "-hide_banner", 
+    ] + input_args
     if USE_NVENC:
         cmd += [
             '-c:v', 'h264_nvenc', 
@@ -389,77 +990,180 @@ def main():
             '-pixel_format', 'yuv444p', 
             '-preset', 'default', 
         ]
-
-    if OUTPUT_FN is not None:
-        cmd.append(OUTPUT_FN)
-    elif isinstance(target, tuple):
-        cmd.append(os.path.join("output", "vertex_" + target[0] + "_" + target[1] + ".mp4"))
     else:
-        cmd.append(os.path.join("output", "vertex_" + target.replace("\\", "/").split("/")[-1] + ".mp4"))
-    print("$ " + " ".join(cmd))
-    subprocess.check_call(cmd)
+        cmd += PRESET_ARGS
+
+    cmd.append(output_fn)
+    return cmd
+
+class FrameStream:
+    # Frames come back from the workers in any order, hold on to them till
+    # it's their turn, then write them out, repeating held frames
+    def __init__(self, f):
+        self.f = f
+        self.next_frame = 0
+        self.pending = {}
+
+    def add(self, frame_no, frames, bits):
+        self.pending[frame_no] = (frames, bits)
+        while self.next_frame in self.pending:
+            frames, bits = self.pending.pop(self.next_frame)
+            for _ in range(frames):
+                self.f.write(bits)
+            self.next_frame += frames
+
+# Outlined text by the string, font size, and outline width
+_text_sprites = {}
+def text_sprite(val, fnt, outline):
+    # The masks for the white outline and the black text, and where they go
+    # compared to where the text is drawn.  The outline is the text drawn
+    # offset in every direction.
+    key = (val, fnt.size, outline)
+    if key not in _text_sprites:
+        if len(_text_sprites) >= 1000:
+            _text_sprites.clear()
+        l, t, r, b = fnt.getbbox(val)
+        left, top = min(0, l) - outline, min(0, t) - outline
+        size = (r - left + outline + 1, b - top + outline + 1)
+        white = Image.new('L', size, 0)
+        dr = ImageDraw.Draw(white)
+        for ox in range(-outline, outline + 1):
+            for oy in range(-outline, outline + 1):
+                dr.text((ox - left, oy - top), val, 255, fnt)
+        black = Image.new('L', size, 0)
+        ImageDraw.Draw(black).text((-left, -top), val, 255, fnt)
+        _text_sprites[key] = (white, black, left, top)
+    return _text_sprites[key]
 
 _fnt_header, _fnt_footer = None, None
+_renderer, _frame = None, None
 def worker(job):
     # Simple hack to return the total number of frames to the caller
     if isinstance(job, int):
         return job
-    # Load the data and draw it
-    data = json.loads(job['data'])
-    im = show_puzzle(data, appear=job.get('appear'), decay=job.get('decay'))
+    # How long each step takes, for the telemetry
+    timings = {}
+    started = time.perf_counter()
+    def stage(name):
+        nonlocal started
+        now = time.perf_counter()
+        timings[name] = timings.get(name, 0) + now - started
+        started = now
+
+    frames_dir = job.get('frames_dir', "frames")
+    frame_fn = os.path.join(frames_dir, frame_filename(job))
+    mirror_fn = os.path.join("frames2", f"frame_{job['frame_no'] + job.get('second_offset', _second_offset):08d}.png")
+    if not job.get('stream', False) and os.path.isfile(frame_fn):
+        # This frame was drawn by an earlier run that didn't finish
+        if SECOND_FRAMES:
+            mirror_frame(frame_fn, mirror_fn)
+        stage("cached")
+        return frame_result(job, frame_fn, timings)
+
+    # Load the puzzle and draw it in the state for this frame
+    puzzle = load_puzzle(job['source'])
+    progress = np.frombuffer(job['progress'], dtype=np.uint8)
+    projected = puzzle.project(RENDER_SIZE, RENDER_SIZE)
+    stage("decode")
+    global _renderer
+    if _renderer is None:
+        _renderer = FrameRenderer()
+    rebuilds = _renderer.rebuilds
+    im = _renderer.render(progress, projected, job['source'], appear=job.get('appear'), decay=job.get('decay'))
+    rebuilds = _renderer.rebuilds - rebuilds
+    stage("render")
 
-    # Add some text
+    # Add some text, sized for a 2000 pixel render
+    scale = RENDER_SIZE / 2000
+    margin = round(10 * scale)
+    outline = max(1, round(2 * scale))
     global _fnt_header, _fnt_footer
     if _fnt_header is None:
-        _fnt_header = ImageFont.truetype(os.path.join("images", "OpenSans-Regular.ttf"), 70)
-        _fnt_footer = ImageFont.truetype(os.path.join("images", "OpenSans-Regular.ttf"), 40)
-    dr = ImageDraw.Draw(im)
+        _fnt_header = ImageFont.truetype(os.path.join("images", "OpenSans-Regular.ttf"), round(70 * scale))
+        _fnt_footer = ImageFont.truetype(os.path.join("images", "OpenSans-Regular.ttf"), round(40 * scale))
 
     # Simple helper to outline text
     def draw_text(x, y, val, fnt):
-        for ox in range(-2, 3):
-            for oy in range(-2, 3):
-                dr.text((x + ox, y + oy), val, (255, 255, 255), fnt)
-        dr.text((x, y), val, (0, 0, 0), fnt)
+        white, black, left, top = text_sprite(val, fnt, outline)
+        box = (x + left, y + top, x + left + white.width, y + top + white.height)
+        im.paste((255, 255, 255), box, white)
+        im.paste((0, 0, 0), box, black)
 
     # Draw the "Theme" at the top
     if 'type' in job:
-        draw_text(10, 10, data['theme'][:job['type']], _fnt_header)
+        draw_text(margin, margin, puzzle.theme[:job['type']], _fnt_header)
     else:
-        draw_text(10, 10, data['theme'], _fnt_header)
+        draw_text(margin, margin, puzzle.theme, _fnt_header)
         # And draw the number of remaining shapes at the bottom
-        left = sum(1 for x in data['shapes'] if not x.get('isPreDrawn', False))
+        left = int((progress < 4).sum())
         left = f"{left:,}"
         size = _fnt_footer.getbbox(left)
-        draw_text(1000 - size[2] // 2, 2000 - (size[3] + 10), left, _fnt_footer)
+        draw_text(RENDER_SIZE // 2 - size[2] // 2, RENDER_SIZE - (size[3] + margin), left, _fnt_footer)
         date = job['source'].replace("\\", "/").split("/")[-1][:10]
         size = _fnt_footer.getbbox(date)
-        draw_text(2000 - (size[2] + 10), 2000 - (size[3] + 10), date, _fnt_footer)
-
-    # Shrink the image down
-    im.thumbnail((1580, 1040))
-    im_big = Image.new('RGB', (1920, 1080), (255, 255, 255))
-    im_big.paste(im, ((im_big.width - im.width) // 2, (im_big.height - im.height) // 2))
-
-    # Save out the frame
-    make_fn = lambda x: os.path.join("frames", f"frame_{x:08d}.png")
-    make_fn_2 = lambda x: os.path.join("frames2", f"frame_{x+_second_offset:08d}.png")
-    source_fn = make_fn(job['frame_no'])
-    im_big.save(source_fn, 'PNG', compress_level=1)
-    if SECOND_FRAMES:
-        shutil.copy(source_fn, make_fn_2(job['frame_no']))
-    im_big.close()
-    im.close()
+        draw_text(RENDER_SIZE - (size[2] + margin), RENDER_SIZE - (size[3] + margin), date, _fnt_footer)
+    stage("text")
 
-    # Copy it if we need more copies
-    for frame in range(job['frame_no']+1, job['frame_no'] + job['frames']):
-        shutil.copy(source_fn, make_fn(frame))
+    # Shrink the image down, leaving a border around it in the frame.  The
+    # render is square, so this is the size thumbnail would pick, but im is
+    # the renderer's buffer so it's resized to a new image instead of in place
+    global _frame
+    side = min(round(FRAME_SIZE[0] * 1580 / 1920), round(FRAME_SIZE[1] * 1040 / 1080), RENDER_SIZE)
+    small = im.resize((side, side), Image.Resampling.BICUBIC, reducing_gap=2.0)
+    if _frame is None:
+        # The same part of the frame is covered every time, so the border
+        # only needs to be cleared once
+        _frame = Image.new('RGB', FRAME_SIZE, (255, 255, 255))
+    _frame.paste(small, ((FRAME_SIZE[0] - side) // 2, (FRAME_SIZE[1] - side) // 2))
+    small.close()
+    stage("thumbnail")
+
+    # Save out the frame, held frames are only saved once, the concat list
+    # has how long they're shown
+    if job.get('stream', False):
+        # The frame goes right back to the main process, only write out
+        # the second copy if that's wanted
+        bits = _frame.tobytes()
         if SECOND_FRAMES:
-            shutil.copy(source_fn, make_fn_2(frame))
+            _frame.save(mirror_fn, 'PNG', compress_level=1)
+        stage("save")
+    else:
+        # Write to a temp file first, so a run that's stopped never leaves
+        # a partial frame behind to be used next time
+        temp_fn = frame_fn + f".{os.getpid()}.tmp"
+        _frame.save(temp_fn, 'PNG', compress_level=1)
+        os.replace(temp_fn, frame_fn)
+        stage("save")
+        if SECOND_FRAMES:
+            mirror_frame(frame_fn, mirror_fn)
+            stage("copy")
+
+    ret = frame_result(job, mirror_fn if job.get('stream', False) else frame_fn, timings)
+    ret['rebuilds'] = rebuilds
+    if job.get('stream', False):
+        ret['bits'] = bits
+    return ret
+
+def mirror_frame(source_fn, mirror_fn):
+    # frames is cleared out by later runs, so frames2 gets a link to the
+    # same file, or a copy if links don't work here
+    if os.path.isfile(mirror_fn):
+        os.unlink(mirror_fn)
+    try:
+        os.link(source_fn, mirror_fn)
+    except OSError:
+        shutil.copy(source_fn, mirror_fn)
 
+def frame_result(job, fn, timings):
     data_fn = job['source'].replace("\\", "/").split("/")[-1]
-    target_fn = source_fn.replace("\\", "/").split("/")[-1]
-    return f"Done with {data_fn}:{target_fn}, {job['left']:,} tris to show, {job['files_left']:,} files left"
+    target_fn = fn.replace("\\", "/").split("/")[-1]
+    return {
+        "frame_no": job['frame_no'], 
+        "frames": job['frames'], 
+        "files_left": job['files_left'], 
+        "timings": timings, 
+        "msg": f"Done with {data_fn}:{target_fn}, {job['left']:,} tris to show, {job['files_left']:,} files left", 
+    }
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+from compiled_puzzle import load_puzzle
+from tile_arena import TileArena
+import animate_data, make_image
+import json, os, platform, random, sys, time
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Number of puzzles to sample from the corpus, 0 means all of them
+SAMPLE = int(os.environ.get("BENCHMARK_SAMPLE", "40"))
+# Number of animation frames to time for each puzzle
+FRAMES = int(os.environ.get("BENCHMARK_FRAMES", "5"))
+# Number of the biggest puzzles to use for the benchmarks that care about size
+LARGEST = int(os.environ.get("BENCHMARK_LARGEST", "5"))
+# How much slower than the baseline the median can be before failing
+THRESHOLD = float(os.environ.get("BENCHMARK_THRESHOLD", "0.15"))
+# Number of frames in a row to draw for each puzzle when timing the frames
+SEQUENCE = int(os.environ.get("BENCHMARK_SEQUENCE", "30"))
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports this in KB, macOS in bytes
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+def rss_mb():
+    # The memory in use right now, only Linux has an easy way to get this
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def page_faults():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+
+def sample_files():
+    files = [fn for file_only, fn in make_image.enum_puzzles() if fn.endswith(".json")]
+    if SAMPLE <= 0 or SAMPLE >= len(files):
+        return files
+    step = len(files) / SAMPLE
+    return [files[int(i * step)] for i in range(SAMPLE)]
+
+def largest_files():
+    files = [fn for file_only, fn in make_image.enum_puzzles() if fn.endswith(".json")]
+    files.sort(key=lambda fn: load_puzzle(fn).shape_count)
+    return files[-LARGEST:]
+
+def summarize(results):
+    # results is a list of (shapes, vertices, seconds)
+    seconds = np.array([x[2] for x in results])
+    shapes = np.array([x[0] for x in results])
+    summary = {
+        "count": len(results),
+        "mean": float(seconds.mean()),
+        "p50": float(np.percentile(seconds, 50)),
+        "p90": float(np.percentile(seconds, 90)),
+        "p99": float(np.percentile(seconds, 99)),
+        "max": float(seconds.max()),
+    }
+
+    # Show how the time grows with the size of the puzzle, both as a few
+    # buckets and as a simple linear fit
+    order = np.argsort(shapes)
+    summary["scaling"] = []
+    for bucket in np.array_split(order, min(5, len(order))):
+        summary["scaling"].append({
+            "shapes": float(shapes[bucket].mean()),
+            "vertices": float(np.mean([results[i][1] for i in bucket])),
+            "mean": float(seconds[bucket].mean()),
+        })
+    if len(set(shapes.tolist())) > 1:
+        summary["per_1000_shapes"] = float(np.polyfit(shapes, seconds, 1)[0] * 1000)
+    return summary
+
+def bench(name, files, func):
+    # Run func over every puzzle, it returns a list of timings, one per call
+    print(f"Running {name}...")
+    results = []
+    faults = 0
+    for fn in files:
+        puzzle = load_puzzle(fn)
+        # Only count page faults while func is running, not while the
+        # puzzle is loaded
+        started = page_faults()
+        for seconds in func(fn, puzzle):
+            results.append((puzzle.shape_count, puzzle.vertex_count, seconds))
+        if started is not None:
+            faults += page_faults() - started
+    summary = summarize(results)
+    summary["peak_rss_mb"] = peak_rss_mb()
+    summary["rss_mb"] = rss_mb()
+    summary["faults_per_run"] = faults / len(results) if resource is not None else None
+    print(f"  {summary['count']:,} runs, p50 {summary['p50'] * 1000:.2f}ms, p90 {summary['p90'] * 1000:.2f}ms, max {summary['max'] * 1000:.2f}ms")
+    if summary["rss_mb"] is not None and summary["faults_per_run"] is not None:
+        print(f"  {summary['rss_mb']:,.1f}MB in use, {summary['faults_per_run']:,.1f} page faults per run")
+    return summary
+
+def timed(func, *args, **kwargs):
+    started = time.perf_counter()
+    ret = func(*args, **kwargs)
+    return time.perf_counter() - started, ret
+
+def bench_make_image(fn, puzzle):
+    took, im = timed(make_image.show_puzzle, puzzle)
+    im.close()
+    yield took
+
+def bench_draw_worker(fn, puzzle):
+    obj = make_image.ObjImage(os.path.basename(fn), fn)
+    obj.i, obj.slot = 0, 0
+    arena = TileArena(1, (obj.width, obj.height), (obj.width + make_image.SHADOW_BORDER * 2, obj.height + make_image.SHADOW_BORDER * 2))
+    make_image._arena = arena
+    try:
+        took, _ = timed(make_image.draw_worker, obj)
+    finally:
+        make_image._arena = None
+        arena.close()
+    yield took
+
+def sample_jobs(fn):
+    jobs = [x for x in animate_data.get_items(fn) if isinstance(x, dict)]
+    step = max(1, len(jobs) // FRAMES)
+    return jobs[::step][:FRAMES]
+
+def bench_animate_show_puzzle(fn, puzzle):
+    projected = puzzle.project(2000, 2000)
+    for job in sample_jobs(fn):
+        progress = np.frombuffer(job['progress'], dtype=np.uint8)
+        took, im = timed(animate_data.show_puzzle, projected, progress, appear=job.get('appear'), decay=job.get('decay'))
+        im.close()
+        yield took
+
+def bench_animate_worker(fn, puzzle):
+    # Frames are drawn to their own directory, so frames left from a real
+    # run are never used in place of drawing them
+    frames_dir = os.path.join("frames", "benchmark")
+    os.makedirs(frames_dir, exist_ok=True)
+    for job in sample_jobs(fn):
+        job = dict(job, frames=1, frames_dir=frames_dir)
+        took, _ = timed(animate_data.worker, job)
+        os.unlink(os.path.join(frames_dir, animate_data.frame_filename(job)))
+        yield took
+    os.rmdir(frames_dir)
+
+def bench_animate_frames(fn, puzzle):
+    # Frames in a row from the middle of a puzzle, streamed so nothing is
+    # written out, the way a worker sees them during a real run
+    jobs = [x for x in animate_data.get_items(fn) if isinstance(x, dict)]
+    start = max(0, len(jobs) // 2 - SEQUENCE // 2)
+    for job in jobs[start:start + SEQUENCE]:
+        took, _ = timed(animate_data.worker, dict(job, stream=True))
+        yield took
+
+def bench_solve_order(fn, puzzle):
+    # Plan every frame of the puzzle, this is what limits how fast the
+    # workers can be fed on big puzzles
+    took, frames = timed(lambda: sum(1 for _ in animate_data.solve_order(puzzle, random.Random(puzzle.content_hash))))
+    yield took
+
+# Each benchmark runs on either the sample of puzzles, or the largest ones
+BENCHMARKS = [
+    ("make_image.show_puzzle", bench_make_image, sample_files),
+    ("make_image.draw_worker", bench_draw_worker, sample_files),
+    ("animate_data.show_puzzle", bench_animate_show_puzzle, sample_files),
+    ("animate_data.worker", bench_animate_worker, sample_files),
+    ("animate_data.frames", bench_animate_frames, sample_files),
+    ("animate_data.solve_order", bench_solve_order, largest_files),
+]
+
+def compare(baseline, current, threshold):
+    # Returns the list of benchmarks that got slower than the threshold allows
+    failed = []
+    for name, summary in current["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+        old = baseline["benchmarks"][name]["p50"]
+        change = summary["p50"] / old - 1
+        status = "FAIL" if change > threshold else "ok"
+        print(f"  {name:30s} {old * 1000:8.2f}ms -> {summary['p50'] * 1000:8.2f}ms ({change:+.1%}) {status}")
+        # Memory is only shown, it depends too much on what ran before to fail on
+        for key, label in [("rss_mb", "MB in use"), ("faults_per_run", "page faults per run")]:
+            if baseline["benchmarks"][name].get(key) is not None and summary.get(key) is not None:
+                print(f"  {'':30s} {baseline['benchmarks'][name][key]:8.1f} -> {summary[key]:8.1f} {label}")
+        if change > threshold:
+            failed.append(name)
+    return failed
+
+def main():
+    if len(sys.argv) not in {2, 3}:
+        print("Usage:")
+        print("  <output.json> [baseline.json] = Run the benchmarks, and compare to a baseline if given")
+        print("Environment:")
+        print("  BENCHMARK_SAMPLE    = Number of puzzles to use, 0 for all")
+        print("  BENCHMARK_FRAMES    = Number of animation frames to time per puzzle")
+        print("  BENCHMARK_LARGEST   = Number of the biggest puzzles to plan")
+        print("  BENCHMARK_SEQUENCE  = Number of frames in a row to draw per puzzle")
+        print("  BENCHMARK_THRESHOLD = Allowed slowdown of the median, 0.15 = 15%")
+        exit(1)
+
+    files = {func: func() for func in set(x[2] for x in BENCHMARKS)}
+    results = {
+        "config": {"sample": len(files[sample_files]), "largest": LARGEST, "frames": FRAMES, "sequence": SEQUENCE, "python": platform.python_version(), "machine": platform.machine()},
+        "benchmarks": {},
+    }
+    for name, func, get_files in BENCHMARKS:
+        results["benchmarks"][name] = bench(name, files[get_files], func)
+
+    with open(sys.argv[1], "wt", newline="", encoding="utf-8") as f:
+        json.dump(results, f, indent=4)
+        f.write("\n")
+    print(f"Results saved to {sys.argv[1]}")
+
+    if len(sys.argv) == 3:
+        with open(sys.argv[2]) as f:
+            baseline = json.load(f)
+        print(f"Compared to {sys.argv[2]}:")
+        failed = compare(baseline, results, THRESHOLD)
+        if len(failed) > 0:
+            print(f"{len(failed)} benchmark(s) are more than {THRESHOLD:.0%} slower than the baseline")
+            exit(1)
+
+if __name__ == "__main__":
+    main()
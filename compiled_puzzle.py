@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+from datetime import datetime
+import collections, hashlib, json, os
+import numpy as np
+
+# Compiled puzzles are stored here, one file per source file
+CACHE_DIR = os.path.join("cache", "puzzles")
+# Bump this if the layout of the compiled data changes
+FORMAT_VERSION = 1
+# How many puzzles load_puzzle keeps in memory, a worker goes through the
+# whole corpus, so this only needs to cover the few puzzles it's on at once
+LOADED_LIMIT = 8
+
+def clean_data(data):
+    # Normalize from different formats to a single format of data
+    for key in ['vertices', 'shapes', 'palettes']:
+        if key not in data and 'body' in data and key in data['body']:
+            data[key] = data['body'][key]
+    if 'palettes' in data and 'palette' not in data:
+        data['palette'] = data['palettes']
+    if isinstance(data["vertices"], list):
+        data["vertices"] = {str(i): x for i, x in enumerate(data["vertices"])}
+    if 'shapes' not in data['vertices']["0"]:
+        for vertex in data['vertices'].values():
+            vertex['shapes'] = []
+        for i, shape in enumerate(data['shapes']):
+            for vertex in shape['vertices']:
+                if i not in data['vertices'][str(vertex)]['shapes']:
+                    data['vertices'][str(vertex)]['shapes'].append(i)
+
+def parse_color(c):
+    # Turn the #rrggbb or #rgb into a normal RGB tuple
+    if len(c) == 4:
+        return (int(c[1], 16) * 17, int(c[2], 16) * 17, int(c[3], 16) * 17)
+    return (int(c[1:3], 16), int(c[3:5], 16), int(c[5:7], 16))
+
+class CompiledPuzzle:
+    # A columnar version of a puzzle, everything is a flat numpy array:
+    #   coords          (vertex, 2) float coordinates
+    #   shape_offsets   shape i uses shape_vertices[shape_offsets[i]:shape_offsets[i+1]]
+    #   vertex_offsets  vertex i is in vertex_shapes[vertex_offsets[i]:vertex_offsets[i+1]]
+    #   palette         (color, 3) RGB values, already decoded
+    ARRAYS = [
+        "coords", "shape_offsets", "shape_vertices", "shape_colors", "shape_predrawn",
+        "vertex_offsets", "vertex_shapes", "vertex_order", "palette",
+    ]
+
+    def __init__(self, meta, **arrays):
+        self.meta = meta
+        for key in CompiledPuzzle.ARRAYS:
+            setattr(self, key, arrays[key])
+        self._projected = None
+
+    @property
+    def theme(self):
+        return self.meta.get('theme', '')
+
+    @property
+    def content_hash(self):
+        return self.meta['content_hash']
+
+    @property
+    def vertex_count(self):
+        return len(self.coords)
+
+    @property
+    def shape_count(self):
+        return len(self.shape_colors)
+
+    def shape(self, i):
+        return self.shape_vertices[self.shape_offsets[i]:self.shape_offsets[i + 1]]
+
+    def vertex_shapes_of(self, i):
+        return self.vertex_shapes[self.vertex_offsets[i]:self.vertex_offsets[i + 1]]
+
+    def project(self, width, height):
+        # Return the puzzle moved into screen space, reusing the last one
+        # if it was for the same size.  Only one is kept, they're big and
+        # everything asks for the same size over and over
+        key = (width, height)
+        if self._projected is None or self._projected[0] != key:
+            self._projected = (key, ProjectedPuzzle(self, width, height))
+        return self._projected[1]
+
+    def save(self, fn, key):
+        # The file is a single JSON header line, followed by the raw bytes of
+        # each array, so loading is just a read and a few np.frombuffer calls
+        header = {"key": list(key), "meta": self.meta, "arrays": []}
+        for name in CompiledPuzzle.ARRAYS:
+            value = getattr(self, name)
+            header["arrays"].append([name, value.dtype.str, list(value.shape)])
+        # Write to a temp file first so workers racing on the same puzzle
+        # never see a partial file
+        temp_fn = fn + f".{os.getpid()}.tmp"
+        with open(temp_fn, "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            for name in CompiledPuzzle.ARRAYS:
+                f.write(np.ascontiguousarray(getattr(self, name)).tobytes())
+        os.replace(temp_fn, fn)
+
+    @staticmethod
+    def load(fn, key):
+        # Returns None if the file is missing or stale
+        try:
+            with open(fn, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return None
+        split = raw.index(b"\n")
+        header = json.loads(raw[:split])
+        if header["key"] != list(key):
+            return None
+        arrays = {}
+        offset = split + 1
+        for name, dtype, shape in header["arrays"]:
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            arrays[name] = np.frombuffer(raw, dtype, count, offset).reshape(shape)
+            offset += count * dtype.itemsize
+        return CompiledPuzzle(header["meta"], **arrays)
+
+class ProjectedPuzzle:
+    # All of the vertices of a puzzle transformed into screen space at once,
+    # along with the point lists for each shape ready to hand to ImageDraw
+    def __init__(self, puzzle, width, height):
+        self.puzzle = puzzle
+        self.width = width
+        self.height = height
+
+        # Figure out the size of the image from the vertex points, and
+        # scale everything to fit in the image
+        min_x, min_y = puzzle.coords.min(axis=0).tolist()
+        max_x, max_y = puzzle.coords.max(axis=0).tolist()
+        length = max(max_x - min_x, max_y - min_y) * 1.1
+        center = np.array([(min_x + max_x) / 2, (min_y + max_y) / 2])
+        size = np.array([width / 2, height / 2])
+        self.points = ((puzzle.coords - center) / (length / 2)) * size + size
+
+        # Pull out the points for every shape in one go
+        flat = self.points[puzzle.shape_vertices]
+        self.shape_arrays = np.split(flat, puzzle.shape_offsets[1:-1])
+        self.shape_points = [x.tolist() for x in self.shape_arrays]
+        for pts in self.shape_points:
+            pts[:] = [tuple(x) for x in pts]
+        self.vertex_points = [tuple(x) for x in self.points.tolist()]
+
+        # The pixel bounding box of each shape, as left, top, right, bottom
+        starts = puzzle.shape_offsets[:-1]
+        self.shape_boxes = np.hstack([
+            np.floor(np.minimum.reduceat(flat, starts, axis=0)),
+            np.ceil(np.maximum.reduceat(flat, starts, axis=0)),
+        ]).astype(np.int64)
+
+def compile_puzzle(data, content_hash=None):
+    # Turn a decoded Vertex data dump into a CompiledPuzzle
+    clean_data(data)
+
+    vertex_order = [int(x) for x in data['vertices']]
+    coords = np.zeros((max(vertex_order) + 1, 2), dtype=np.float64)
+    for key, value in data['vertices'].items():
+        coords[int(key)] = value['coordinates']
+
+    shape_offsets = [0]
+    shape_vertices = []
+    adjacent = [[] for _ in range(len(coords))]
+    for i, shape in enumerate(data['shapes']):
+        for vertex in shape['vertices']:
+            shape_vertices.append(vertex)
+            if len(adjacent[vertex]) == 0 or adjacent[vertex][-1] != i:
+                adjacent[vertex].append(i)
+        shape_offsets.append(len(shape_vertices))
+
+    vertex_offsets = [0]
+    for cur in adjacent:
+        vertex_offsets.append(vertex_offsets[-1] + len(cur))
+
+    meta = {key: value for key, value in data.items() if isinstance(value, (str, int, float, bool))}
+    if content_hash is None:
+        content_hash = hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+    meta['content_hash'] = content_hash
+
+    return CompiledPuzzle(
+        meta,
+        coords=coords,
+        shape_offsets=np.array(shape_offsets, dtype=np.int32),
+        shape_vertices=np.array(shape_vertices, dtype=np.int32),
+        shape_colors=np.array([int(x['color']) for x in data['shapes']], dtype=np.int32),
+        shape_predrawn=np.array([x.get('isPreDrawn', False) for x in data['shapes']], dtype=np.bool_),
+        vertex_offsets=np.array(vertex_offsets, dtype=np.int32),
+        vertex_shapes=np.array([x for cur in adjacent for x in cur], dtype=np.int32),
+        vertex_order=np.array(vertex_order, dtype=np.int32),
+        palette=np.array([parse_color(x) for x in data['palette']], dtype=np.uint8).reshape(-1, 3),
+    )
+
+_loaded = collections.OrderedDict()
+def load_puzzle(fn, cache_dir=CACHE_DIR):
+    # Load a puzzle, using the compiled version if it's still current
+    stat = os.stat(fn)
+    key = (FORMAT_VERSION, stat.st_mtime_ns, stat.st_size)
+    memo = _loaded.get(fn)
+    if memo is not None and memo[0] == key:
+        _loaded.move_to_end(fn)
+        return memo[1]
+
+    cache_fn = None
+    if cache_dir is not None:
+        name = hashlib.sha1(os.path.abspath(fn).encode("utf-8")).hexdigest()
+        cache_fn = os.path.join(cache_dir, name + ".bin")
+        puzzle = CompiledPuzzle.load(cache_fn, key)
+    else:
+        puzzle = None
+
+    if puzzle is None:
+        with open(fn, "rb") as f:
+            raw = f.read()
+        puzzle = compile_puzzle(json.loads(raw), hashlib.sha1(raw).hexdigest())
+        if cache_fn is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            puzzle.save(cache_fn, key)
+
+    _loaded[fn] = (key, puzzle)
+    _loaded.move_to_end(fn)
+    while len(_loaded) > LOADED_LIMIT:
+        _loaded.popitem(last=False)
+    return puzzle
+
+def main():
+    # Compile everything ahead of time, normally this happens on demand
+    started = datetime.now()
+    count = 0
+    for base_dir in ["data", "extra"]:
+        for dirname, dirnames, filenames in os.walk(base_dir):
+            for fn in sorted(filenames):
+                if fn.endswith(".json"):
+                    load_puzzle(os.path.join(dirname, fn))
+                    count += 1
+    print(f"Compiled {count:,} puzzles in {(datetime.now() - started).total_seconds():.2f} seconds.")
+
+if __name__ == "__main__":
+    main()
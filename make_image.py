@@ -1,69 +1,68 @@
 #!/usr/bin/env python3
 
+from compiled_puzzle import compile_puzzle, load_puzzle
 from datetime import datetime, timedelta
-from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageOps
-import io, json, multiprocessing, os, sys
+from tile_arena import TileArena
+from tile_cache import TileCache
+from tile_pyramid import write_pyramid
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageFilter, ImageOps
+import hashlib, io, json, multiprocessing, os, struct, sys, time, zlib
+import numpy as np
 
-def show_puzzle(data, transparent=False, solid_color=None):
-    # Simple helper to decode a Vertex data dump into an image
+# Puzzles are drawn at this multiple of the size they're shown at, then shrunk
+SUPERSAMPLE = 4
 
-    # Normalize from different formats to a single format of data
-    for key in ['vertices', 'shapes', 'palettes']:
-        if key not in data and 'body' in data and key in data['body']:
-            data[key] = data['body'][key]
-    if 'palettes' in data and 'palette' not in data:
-        data['palette'] = data['palettes']
-    if isinstance(data["vertices"], list):
-        data["vertices"] = {str(i): x for i, x in enumerate(data["vertices"])}
-    if 'shapes' not in data['vertices']["0"]:
-        for vertex in data['vertices'].values():
-            vertex['shapes'] = []
-        for i, shape in enumerate(data['shapes']):
-            for vertex in shape['vertices']:
-                if i not in data['vertices'][str(vertex)]['shapes']:
-                    data['vertices'][str(vertex)]['shapes'].append(i)
-
-    # Run through all of the vertex points and figure out the size of the image
-    min_x, min_y, max_x, max_y = None, None, None, None
-    for key, value in data["vertices"].items():
-        x, y = value["coordinates"]
-        if min_x is None:
-            min_x, min_y, max_x, max_y = x, y, x, y
-        else:
-            min_x = min(min_x, x)
-            max_x = max(max_x, x)
-            min_y = min(min_y, y)
-            max_y = max(max_y, y)
+def show_puzzle(data, transparent=False, solid_color=None, size=1000):
+    # Simple helper to decode a Vertex data dump into an image
+    if isinstance(data, dict):
+        data = compile_puzzle(data)
 
-    # Scale everthing to a big image
-    width, height = 1000, 1000
-    length = max(max_x - min_x, max_y - min_y) * 1.1
+    # Scale everthing to the size of the image
+    width, height = size, size
+    projected = data.project(width, height)
 
     # Draw each polygon in turn
     im = Image.new('RGBA' if transparent else 'RGB', (width, height), (255, 255, 255, 0) if transparent else (255, 255, 255))
     dr = ImageDraw.Draw(im)
-    for shape in data["shapes"]:
-        pts = []
-        for cur in shape["vertices"]:
-            x, y = data["vertices"][str(cur)]["coordinates"]
-            x = ((x - ((min_x + max_x) / 2)) / (length / 2)) * (width / 2) + (width / 2)
-            y = ((y - ((min_y + max_y) / 2)) / (length / 2)) * (height / 2) + (height / 2)
-            pts.append((x, y))
-        if solid_color is None:
-            c = int(shape["color"])
-            c = data["palette"][c]
-            # Turn the #rrggbb or #rgb into a normal PIL color tuple
-            if len(c) == 4:
-                c = (int(c[1], 16) * 17, int(c[2], 16) * 17, int(c[3], 16) * 17) + ((255,) if transparent else tuple())
-            else:
-                c = (int(c[1:3], 16), int(c[3:5], 16), int(c[5:7], 16)) + ((255,) if transparent else tuple())
-        else:
-            c = solid_color
+    if solid_color is None:
+        palette = [tuple(x) + ((255,) if transparent else tuple()) for x in data.palette.tolist()]
+    for i, pts in enumerate(projected.shape_points):
+        c = palette[data.shape_colors[i]] if solid_color is None else solid_color
         # Draw the polygon
         dr.polygon(pts, c)
 
     return im
 
+def render_puzzle(data, size, supersample=SUPERSAMPLE, transparent=False, solid_color=None):
+    # Draw a puzzle that will be shown at size x size, only drawing as many
+    # pixels as the supersampling needs
+    im = show_puzzle(data, transparent, solid_color, size * supersample)
+    if supersample > 1:
+        im = im.resize((size, size), Image.Resampling.LANCZOS)
+    return im
+
+def check_render(size=70, step=25):
+    # Compare drawing at the target size with different amounts of supersampling
+    # against the old way of drawing a big image and shrinking it
+    puzzles = [load_puzzle(fn) for i, (file_only, fn) in enumerate(enum_puzzles()) if i % step == 0]
+    started = time.perf_counter()
+    reference = []
+    for data in puzzles:
+        im = show_puzzle(data)
+        im.thumbnail((size, size), Image.Resampling.LANCZOS)
+        reference.append(im)
+    took = (time.perf_counter() - started) / len(puzzles)
+    print(f"Reference: {1000 * 1000:>9,} pixels, {took * 1000:7.2f}ms per puzzle")
+    for supersample in [1, 2, 4, 8]:
+        started = time.perf_counter()
+        ims = [render_puzzle(data, size, supersample) for data in puzzles]
+        took = (time.perf_counter() - started) / len(puzzles)
+        diffs = [np.abs(np.asarray(a, dtype=np.int16) - np.asarray(b, dtype=np.int16)) for a, b in zip(ims, reference)]
+        print(
+            f"{supersample}x:        {(size * supersample) ** 2:>9,} pixels, {took * 1000:7.2f}ms per puzzle, "
+            f"difference: max {max(x.max() for x in diffs)}, mean {np.mean([x.mean() for x in diffs]):.3f}"
+        )
+
 def enum_puzzles():
     # Simple helper to enumerate a directory and return the results
     # in alphabetical order
@@ -78,40 +77,111 @@ def enum_puzzles():
                 yield fn, cur
 
 def load_single_image(fn):
-    with open(fn) as f:
-        data = json.load(f)
-    im = show_puzzle(data)
+    im = show_puzzle(load_puzzle(fn))
     output_fn = os.path.join("images", "single_image.png")
     im.save(output_fn)
     print(f"File {fn} saved as {output_fn}")
 
+# Size of the shadow around each tile, and how much to blur it, as a
+# fraction of the size the puzzle is drawn at
+SHADOW_BORDER = 10
+SHADOW_BLUR = 0.0875
+# Shadows are blurred at this multiple of the final tile size
+SHADOW_SCALE = 4
+# Bump this if the way tiles are drawn changes, to invalidate the tile cache
+TILE_VERSION = 2
+
+def make_shadow(im, width, height, shadow_border, scale=SHADOW_SCALE, blur=SHADOW_BLUR):
+    # Turn the alpha channel of an already drawn puzzle into a drop shadow
+    # for a width x height tile, doing the blur near the output size
+    # instead of on the full sized image
+    border = shadow_border * (im.width // width)
+    full_size = im.width + border * 2
+    out_size = (width + shadow_border * 2, height + shadow_border * 2)
+    mask = ImageOps.expand(im.getchannel("A"), border, 0)
+    mask = mask.resize((out_size[0] * scale, out_size[1] * scale), Image.Resampling.BOX)
+    mask = mask.filter(ImageFilter.BoxBlur(blur * im.width * mask.width / full_size))
+    mask = mask.resize(out_size, Image.Resampling.LANCZOS)
+    # Fade the color out to white along with the alpha, the same thing blurring
+    # a solid gray shape on a transparent white background does
+    temp = mask.point(lambda x: 255 - (155 * x + 127) // 255)
+    return Image.merge("RGBA", (temp, temp, temp, mask))
+
+def make_shadow_reference(data, width, height, shadow_border):
+    # The original way to make a shadow, draw everything in gray and blur
+    # the full sized image.  Only used to check make_shadow
+    temp = show_puzzle(data, transparent=True, solid_color=(100, 100, 100))
+    border_x = shadow_border * (temp.width // width)
+    border_y = shadow_border * (temp.height // height)
+    temp = ImageOps.expand(temp, (border_x, border_y), (255, 255, 255, 0))
+    temp = temp.filter(ImageFilter.BoxBlur((temp.width - border_x * 2) * SHADOW_BLUR))
+    temp.thumbnail((width + shadow_border * 2, height + shadow_border * 2), Image.Resampling.LANCZOS)
+    return temp
+
+def check_shadows(tolerance=8, step=25, tile_tolerance=10):
+    # Compare the fast shadows to the reference ones on a sample of the
+    # puzzles, as they'd look on the final white background.  make_shadow
+    # itself is checked on the same 1000 pixel render the reference blurs.
+    # Tiles hand it the supersampled 280 pixel render instead, and drawing
+    # the polygons that small moves the edges of the shadow by up to 3/255
+    # more in either direction (the mean stays under 0.5/255), which no
+    # amount of blurring takes back out, so tiles get tile_tolerance
+    def flatten(im):
+        bg = Image.new('RGB', im.size, (255, 255, 255))
+        bg.paste(im, (0, 0), im)
+        return bg.convert('L')
+    ok = True
+    for size, limit in [(1000, tolerance), (70 * SUPERSAMPLE, tile_tolerance)]:
+        worst = 0
+        for i, (file_only, fn) in enumerate(enum_puzzles()):
+            if i % step == 0:
+                data = load_puzzle(fn)
+                fast = make_shadow(show_puzzle(data, transparent=True, size=size), 70, 70, SHADOW_BORDER)
+                slow = make_shadow_reference(data, 70, 70, SHADOW_BORDER)
+                diff = ImageChops.difference(flatten(fast), flatten(slow)).getextrema()[1]
+                worst = max(worst, diff)
+                if diff > limit:
+                    print(f"{file_only}: shadow from a {size} pixel render is off by {diff}")
+        print(f"From {size} pixel renders, worst difference is {worst}, tolerance is {limit}")
+        ok = ok and worst <= limit
+    return ok
+
+_arena = None
+def set_arena(spec):
+    # Attach each worker to the shared memory the tiles are written to
+    global _arena
+    _arena = TileArena.attach(spec)
+
 def draw_worker(cur):
-    # Decode the data into an image and place it on the final image
-    with open(cur.fn) as f:
-        data = json.load(f)
+    # Decode the data into an image and place it in the tile's slot
+    data = load_puzzle(cur.fn)
 
-    temp = show_puzzle(data, transparent=True)
-    temp.thumbnail((cur.width, cur.height), Image.Resampling.LANCZOS)
-    bits = io.BytesIO()
-    temp.save(bits, 'PNG')
-    image_bits = bits.getvalue()
+    # Only draw the puzzle once, just big enough for the supersampling, the
+    # shadow comes from its alpha channel
+    temp = show_puzzle(data, transparent=True, size=cur.width * SUPERSAMPLE)
+    shadow = make_shadow(temp, cur.width, cur.height, SHADOW_BORDER)
+
+    temp = temp.resize((cur.width, cur.height), Image.Resampling.LANCZOS)
+    _arena.put(cur.slot, temp, shadow)
     temp.close()
+    shadow.close()
 
-    temp = show_puzzle(data, transparent=True, solid_color=(100, 100, 100))
-    shadow_border = 10
-    border_x = shadow_border * (temp.width // cur.width)
-    border_y = shadow_border * (temp.height // cur.height)
-    temp = ImageOps.expand(temp, (border_x, border_y), (255, 255, 255, 0))
-    temp = temp.filter(ImageFilter.BoxBlur(cur.width * 1.25))
-    temp.thumbnail((cur.width + shadow_border * 2, cur.height + shadow_border * 2), Image.Resampling.LANCZOS)
+    return cur.i
+
+def encode_png(im):
     bits = io.BytesIO()
-    temp.save(bits, 'PNG')
-    shadow_bits = bits.getvalue()
-    temp.close()
+    im.save(bits, 'PNG')
+    return bits.getvalue()
 
-    return cur.i, image_bits, shadow_bits, shadow_border
+def tile_key(data, width, height):
+    # Everything that changes how a tile looks goes into its cache key
+    key = json.dumps([TILE_VERSION, data.content_hash, width, height, SUPERSAMPLE, SHADOW_BORDER, SHADOW_BLUR, SHADOW_SCALE])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
 
 class Layout:
+    # The layers, in the order they're drawn
+    LAYERS = ["shadow", "image", "text"]
+
     def __init__(self, max_width=None, padding=0):
         self.objects = []
         self.row = []
@@ -137,19 +207,163 @@ class Layout:
             self.y += max(obj.height for obj in self.row)
             self.row = []
 
-    def draw(self):
+    def size(self):
         width = max(obj.x + obj.width + self.padding for obj in self.objects)
         height = max(obj.y + obj.height + self.padding for obj in self.objects)
-        im = Image.new('RGB', (width, height), (255, 255, 255))
+        return width, height
+
+    def draw(self):
+        width, height = self.size()
+        return self.draw_region(0, 0, width, height)
+
+    def objects_in(self, layer, left, top, right, bottom):
+        # All of the objects that draw something inside of this region on a layer
+        for obj in self.objects:
+            if layer in obj.layers:
+                obj_left, obj_top, obj_right, obj_bottom = obj.bounds(layer)
+                if obj_left < right and obj_right > left and obj_top < bottom and obj_bottom > top:
+                    yield obj
+
+    def draw_region(self, left, top, right, bottom):
+        # Draw just part of the layout, only touching the objects that
+        # show up in that part
+        im = Image.new('RGB', (right - left, bottom - top), (255, 255, 255))
         dr = ImageDraw.Draw(im)
         # Draw each layer in turn
-        for layer in ["shadow", "image", "text"]:
-            for obj in self.objects:
-                if layer in obj.layers:
-                    # This object wants to be drawn on this layer, so let it draw itself
-                    obj.draw(layer, im, dr)
+        for layer in Layout.LAYERS:
+            for obj in self.objects_in(layer, left, top, right, bottom):
+                # This object wants to be drawn on this layer, so let it draw itself
+                obj.draw(layer, im, dr, left, top)
         return im
 
+    def draw_to_file(self, fn, band_height=256, keep_from=None, keep_rows=0):
+        # Draw the layout one band at a time, writing each band out as we go,
+        # so memory use doesn't grow with the size of the final image.  The
+        # first keep_rows rows can be copied from an older version of the image
+        width, height = self.size()
+        with PngWriter(fn, width, height) as png:
+            if keep_rows > 0:
+                with PngReader(keep_from) as old:
+                    for top in range(0, keep_rows, band_height):
+                        rows = old.read(min(keep_rows, top + band_height) - top)
+                        png.write(Image.fromarray(rows.reshape(rows.shape[0], width, 3), "RGB"))
+            for top in range(keep_rows, height, band_height):
+                band = self.draw_region(0, top, width, min(height, top + band_height))
+                png.write(band)
+                band.close()
+
+    def manifest(self, params):
+        # Enough information to tell what changed in a later version of the layout
+        width, height = self.size()
+        objects = []
+        for obj in self.objects:
+            layers = [layer for layer in Layout.LAYERS if layer in obj.layers]
+            objects.append({
+                "sig": [obj.signature(layer) for layer in layers],
+                "top": min([obj.bounds(layer)[1] for layer in layers], default=obj.y),
+            })
+        return {"params": params, "width": width, "height": height, "objects": objects}
+
+class PngWriter:
+    # Write an RGB PNG file a few rows at a time.  Every row uses the "Up"
+    # filter, which gets close to what PIL produces for these images
+    def __init__(self, fn, width, height, compress_level=6):
+        self.width = width
+        self.height = height
+        self.f = open(fn, "wb")
+        self.zlib = zlib.compressobj(compress_level)
+        self.prev = np.zeros(width * 3, dtype=np.uint8)
+        self.rows = 0
+        self.f.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _chunk(self, kind, data):
+        self.f.write(struct.pack(">I", len(data)) + kind + data)
+        self.f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def write(self, im):
+        rows = np.asarray(im.convert("RGB")).reshape(im.height, self.width * 3)
+        prev = np.vstack([self.prev[np.newaxis], rows[:-1]])
+        filtered = np.empty((im.height, self.width * 3 + 1), dtype=np.uint8)
+        filtered[:, 0] = 2
+        filtered[:, 1:] = rows - prev
+        self.prev = rows[-1].copy()
+        self.rows += im.height
+        data = self.zlib.compress(filtered.tobytes())
+        if len(data) > 0:
+            self._chunk(b"IDAT", data)
+
+    def close(self):
+        if self.f is None:
+            return
+        if self.rows != self.height:
+            raise ValueError(f"Wrote {self.rows} rows to a PNG with a height of {self.height}")
+        self._chunk(b"IDAT", self.zlib.flush())
+        self._chunk(b"IEND", b"")
+        self.f.close()
+        self.f = None
+
+class PngReader:
+    # Read an RGB PNG file a few rows at a time.  This only understands the
+    # filters PngWriter uses, anything else raises a ValueError
+    def __init__(self, fn):
+        self.f = open(fn, "rb")
+        try:
+            if self.f.read(8) != b"\x89PNG\r\n\x1a\n":
+                raise ValueError(f"{fn} is not a PNG file")
+            kind, data = self._chunk()
+            self.width, self.height, depth, color, _, _, interlace = struct.unpack(">IIBBBBB", data)
+            if kind != b"IHDR" or depth != 8 or color != 2 or interlace != 0:
+                raise ValueError(f"{fn} is not an 8-bit RGB PNG file")
+        except:
+            self.f.close()
+            raise
+        self.zlib = zlib.decompressobj()
+        self.pending = b""
+        self.prev = np.zeros(self.width * 3, dtype=np.uint8)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+
+    def _chunk(self):
+        size, kind = struct.unpack(">I4s", self.f.read(8))
+        data = self.f.read(size)
+        self.f.read(4)
+        return kind, data
+
+    def read(self, count):
+        # Return the next count rows as a (count, width * 3) array
+        stride = self.width * 3 + 1
+        while len(self.pending) < stride * count:
+            kind, data = self._chunk()
+            if kind == b"IDAT":
+                self.pending += self.zlib.decompress(data)
+            elif kind == b"IEND":
+                raise ValueError("Ran out of rows in the PNG file")
+        raw = np.frombuffer(self.pending, dtype=np.uint8, count=stride * count).reshape(count, stride)
+        self.pending = self.pending[stride * count:]
+        rows = np.empty((count, self.width * 3), dtype=np.uint8)
+        for i in range(count):
+            if raw[i, 0] == 0:
+                rows[i] = raw[i, 1:]
+            elif raw[i, 0] == 1:
+                rows[i] = np.cumsum(raw[i, 1:].reshape(-1, 3), axis=0, dtype=np.uint8).reshape(-1)
+            elif raw[i, 0] == 2:
+                rows[i] = raw[i, 1:] + self.prev
+            else:
+                raise ValueError(f"Unsupported PNG filter {raw[i, 0]}")
+            self.prev = rows[i]
+        return rows
+
 class ObjBase:
     def __init__(self, width, height, layers):
         self.x = 0
@@ -157,6 +371,12 @@ class ObjBase:
         self.width = width
         self.height = height
         self.layers = layers
+    def bounds(self, layer):
+        # The area this object touches when drawing this layer
+        return self.x, self.y, self.x + self.width, self.y + self.height
+    def signature(self, layer):
+        # Something that changes if the way this object draws a layer changes
+        return [type(self).__name__, layer, self.x, self.y, self.width, self.height]
 
 class ObjText(ObjBase):
     def __init__(self, val, font_size):
@@ -167,20 +387,22 @@ class ObjText(ObjBase):
         super().__init__((x2 - x1) + (self.pad * 2), (y2 - y1) + (self.pad * 2), {"text"})
         self.off_x = x1
         self.off_y = y1
-    def draw(self, layer, im, dr):
-        dr.text((self.x - self.off_x + self.pad, self.y - self.off_y + self.pad), self.val, (0, 0, 0), self.fnt)
+    def signature(self, layer):
+        return super().signature(layer) + [self.val, self.fnt.size]
+    def draw(self, layer, im, dr, left=0, top=0):
+        dr.text((self.x - left - self.off_x + self.pad, self.y - top - self.off_y + self.pad), self.val, (0, 0, 0), self.fnt)
 
 class ObjBlank(ObjBase):
     def __init__(self, layers):
         super().__init__(70, 70, layers)
-    def draw(self, layer, im, dr):
+    def draw(self, layer, im, dr, left=0, top=0):
         pass
 
 class ObjMissing(ObjBlank):
     TARGET = None
     def __init__(self):
         super().__init__({"image"})
-    def draw(self, layer, im, dr):
+    def draw(self, layer, im, dr, left=0, top=0):
         if ObjMissing.TARGET is None:
             missing_size = 1000
             square_size = 150
@@ -191,24 +413,29 @@ class ObjMissing(ObjBlank):
                     empty_draw.rectangle((x, y, x+square_size, y+square_size), (225, 225, 225, 255) if ((xi + yi) % 2 == 0) else (255, 255, 255, 255))
             empty.thumbnail((self.width, self.height), Image.Resampling.LANCZOS)
             ObjMissing.TARGET = empty
-        im.paste(ObjMissing.TARGET, (self.x, self.y), ObjMissing.TARGET)
+        im.paste(ObjMissing.TARGET, (self.x - left, self.y - top), ObjMissing.TARGET)
     
 class ObjImage(ObjBlank):
     def __init__(self, file_only, fn):
         super().__init__({"image", "shadow"})
         self.file_only = file_only
         self.fn = fn
-    def draw(self, layer, im, dr):
-        bits = io.BytesIO(self.image if (layer == "image") else self.shadow)
-        temp = Image.open(bits)
-        im.paste(temp, (self.x - (0 if (layer == "image") else self.shadow_border), self.y - (0 if (layer == "image") else self.shadow_border)), temp)
+        self.key = tile_key(load_puzzle(fn), self.width, self.height)
+        self.shadow_border = SHADOW_BORDER
+    def bounds(self, layer):
+        if layer == "shadow":
+            border = self.shadow_border
+            return self.x - border, self.y - border, self.x + self.width + border, self.y + self.height + border
+        return super().bounds(layer)
+    def signature(self, layer):
+        return super().signature(layer) + [self.key]
+    def draw(self, layer, im, dr, left=0, top=0):
+        temp = self.arena.image(self.slot) if (layer == "image") else self.arena.shadow(self.slot)
+        im.paste(temp, (self.x - left - (0 if (layer == "image") else self.shadow_border), self.y - top - (0 if (layer == "image") else self.shadow_border)), temp)
         temp.close()
 
-def main():
-    if len(sys.argv) == 2:
-        load_single_image(sys.argv[1])
-        exit(0)
-
+def build_layout():
+    # Place every puzzle, placeholder, and header in the final image
     layout = Layout(padding=5)
 
     # Find all the images
@@ -255,23 +482,140 @@ def main():
 
         last_at = at
 
-    # Prepare the data for all of the images
-    todo = []
-    for i, cur in enumerate(layout.objects):
-        if isinstance(cur, ObjImage):
-            cur.i = i
-            todo.append(cur)
+    return layout
+
+def draw_tiles(layout, needed=None):
+    # Every tile gets a slot in shared memory for its image and shadow, the
+    # workers draw right into it, and the layout pastes right out of it.  If
+    # needed is passed in, only those objects are prepared
+    tiles = [cur for cur in layout.objects if isinstance(cur, ObjImage) and (needed is None or cur in needed)]
+    size = (tiles[0].width, tiles[0].height) if len(tiles) > 0 else (0, 0)
+    arena = TileArena(len(tiles), size, (size[0] + SHADOW_BORDER * 2, size[1] + SHADOW_BORDER * 2))
+
+    try:
+        # Prepare the data for all of the images, reusing any tiles we've
+        # already drawn, since old puzzles never change
+        cache = TileCache()
+        todo = []
+        tile_ids = set(id(cur) for cur in tiles)
+        slot = 0
+        for i, cur in enumerate(layout.objects):
+            if id(cur) in tile_ids:
+                cur.i = i
+                cur.slot = slot
+                slot += 1
+                cached = cache.get(cur.key)
+                if cached is None:
+                    todo.append(cur)
+                else:
+                    with Image.open(io.BytesIO(cached[0])) as image, Image.open(io.BytesIO(cached[1])) as shadow:
+                        arena.put(cur.slot, image, shadow)
+
+        # Draw everything else in a pool to speed it up a bit
+        if len(todo) > 0:
+            with multiprocessing.Pool(initializer=set_arena, initargs=(arena.spec(),)) as pool:
+                for i in pool.imap_unordered(draw_worker, todo):
+                    cur = layout.objects[i]
+                    cache.put(cur.key, encode_png(arena.image(cur.slot)), encode_png(arena.shadow(cur.slot)))
+        cache.evict()
+        print(f"Drew {len(todo):,} tiles, {cache.hits:,} came from the cache")
+    except:
+        # Nothing else will release the shared memory if this fails
+        arena.close()
+        raise
+
+    for cur in tiles:
+        cur.arena = arena
+    return arena
+
+# Bump this if the way the preview is drawn changes, to force a full rebuild
+PREVIEW_VERSION = 1
+
+def preview_params(layout):
+    # If any of these change, the old preview can't be reused
+    return [PREVIEW_VERSION, TILE_VERSION, layout.padding, SUPERSAMPLE, SHADOW_BORDER, SHADOW_BLUR, SHADOW_SCALE]
+
+def can_keep_rows(fn, width, rows, band_height=256):
+    # The old preview might have been saved again by something else, with
+    # filters PngReader doesn't understand, so make sure every row that's
+    # kept can be read before deciding what to draw
+    try:
+        with PngReader(fn) as old:
+            if old.width != width or old.height < rows:
+                return False
+            for top in range(0, rows, band_height):
+                old.read(min(rows, top + band_height) - top)
+    except (ValueError, OSError, struct.error, zlib.error):
+        return False
+    return True
+
+def write_preview(layout, fn, manifest_fn, incremental=False):
+    # Draw the preview, if incremental is set and the old preview can be
+    # used, only the rows after the first change are drawn again
+    manifest = layout.manifest(preview_params(layout))
+    keep_rows = 0
+    needed = None
+    if incremental and os.path.isfile(fn) and os.path.isfile(manifest_fn):
+        with open(manifest_fn) as f:
+            old = json.load(f)
+        if old["params"] != manifest["params"] or old["width"] != manifest["width"]:
+            print("Layout parameters changed, drawing everything")
+        else:
+            # Everything before the first changed object is the same, so
+            # find the highest row any changed object draws on
+            first = 0
+            while first < min(len(old["objects"]), len(manifest["objects"])) and old["objects"][first] == manifest["objects"][first]:
+                first += 1
+            tops = [x["top"] for x in old["objects"][first:] + manifest["objects"][first:]]
+            if len(tops) == 0 and old["height"] == manifest["height"]:
+                print("Preview is already up to date")
+                return
+            keep_rows = max(0, min(tops + [old["height"], manifest["height"]]))
+            if keep_rows > 0 and not can_keep_rows(fn, manifest["width"], keep_rows):
+                print("Old preview can't be read back, drawing everything")
+                keep_rows = 0
+            else:
+                needed = set(layout.objects_in("shadow", 0, keep_rows, manifest["width"], manifest["height"]))
+                needed |= set(layout.objects_in("image", 0, keep_rows, manifest["width"], manifest["height"]))
+                print(f"Keeping {keep_rows:,} of {manifest['height']:,} rows from the old preview")
+
+    arena = draw_tiles(layout, needed)
+    try:
+        # Draw to a temp file, since the old one might be read from
+        temp_fn = fn + ".tmp"
+        layout.draw_to_file(temp_fn, keep_from=fn, keep_rows=keep_rows)
+        os.replace(temp_fn, fn)
+    finally:
+        arena.close()
+    with open(manifest_fn, "wt", newline="", encoding="utf-8") as f:
+        json.dump(manifest, f)
+        f.write("\n")
+
+def main():
+    if len(sys.argv) >= 2 and sys.argv[1] == "check_shadows":
+        ok = check_shadows(*[int(x) for x in sys.argv[2:3]])
+        exit(0 if ok else 1)
+
+    if len(sys.argv) >= 2 and sys.argv[1] == "check_render":
+        check_render(*[int(x) for x in sys.argv[2:3]])
+        exit(0)
+
+    mode = sys.argv[1] if len(sys.argv) == 2 else None
+    if mode is not None and mode not in {"pyramid", "update"}:
+        load_single_image(sys.argv[1])
+        exit(0)
 
-    # Draw everything in a pool to speed it up a bit    
-    with multiprocessing.Pool() as pool:
-        for i, image, shadow, shadow_border in pool.imap_unordered(draw_worker, todo):
-            layout.objects[i].image = image
-            layout.objects[i].shadow = shadow
-            layout.objects[i].shadow_border = shadow_border
+    layout = build_layout()
 
     # And finally draw all the things
-    im = layout.draw()
-    im.save(os.path.join("images", "preview.png"))
+    if mode == "pyramid":
+        arena = draw_tiles(layout)
+        try:
+            write_pyramid(layout, os.path.join("images", "preview.dzi"))
+        finally:
+            arena.close()
+    else:
+        write_preview(layout, os.path.join("images", "preview.png"), os.path.join("images", "preview.json"), incremental=(mode == "update"))
     print("Done!")
 
 if __name__ == "__main__":
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
+from compiled_puzzle import load_puzzle
 from datetime import datetime, timedelta
-from make_image import show_puzzle
+from make_image import render_puzzle
 import html, json, os, re
 
 SERIALIZE_DATA = os.path.join(os.path.expanduser("~"), ".vertex-data.json")
@@ -131,9 +132,7 @@ else:
 
     # Load the data from the puzzle data
     for at, fn in walk_dir('data', {'json'}):
-        with open(fn) as f:
-            temp = json.load(f)
-        data.add(at[:10], 'json', fn, temp['theme'], use_title=True)
+        data.add(at[:10], 'json', fn, load_puzzle(fn).theme, use_title=True)
 
     if SERIALIZE_DATA is not None:
         data.serialize(SERIALIZE_DATA)
@@ -270,11 +269,8 @@ img {
                     os.makedirs(img_dn)
                 img_fn = os.path.join(img_dn, cur + ".png")
                 if not os.path.isfile(img_fn):
-                    with open(value['json']) as f_puzzle:
-                        temp = json.load(f_puzzle)
                     print("Create image for " + cur)
-                    im = show_puzzle(temp)
-                    im.thumbnail((300, 300))
+                    im = render_puzzle(load_puzzle(value['json']), 300, supersample=2)
                     im.save(img_fn)
                 url = f"https://github.com/Q726kbXuN/vertex/blob/master/data/{at.strftime('%Y')}/{at.strftime('%m')}/{cur}.json"
                 f.write(f'<span class="obj"><a href="{url}"><img loading="lazy" src="{github(img_fn)}">')
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+from multiprocessing import shared_memory
+from PIL import Image
+
+class TileArena:
+    # A block of shared memory with a slot for the raw RGBA image and shadow
+    # of every tile, so workers can hand tiles back to the compositor without
+    # encoding or pickling them
+    def __init__(self, count, image_size, shadow_size, name=None):
+        self.count = count
+        self.image_size = tuple(image_size)
+        self.shadow_size = tuple(shadow_size)
+        self.image_bytes = self.image_size[0] * self.image_size[1] * 4
+        self.shadow_bytes = self.shadow_size[0] * self.shadow_size[1] * 4
+        self.slot_bytes = self.image_bytes + self.shadow_bytes
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(1, count * self.slot_bytes))
+        else:
+            try:
+                self.shm = shared_memory.SharedMemory(name, track=False)
+            except TypeError:
+                # Before Python 3.13 there's no way to skip tracking, but pool
+                # workers share the resource tracker with the process that made
+                # the memory, so it's still only removed once
+                self.shm = shared_memory.SharedMemory(name)
+
+    def spec(self):
+        # What another process needs to attach to this arena
+        return self.count, self.image_size, self.shadow_size, self.shm.name
+
+    @staticmethod
+    def attach(spec):
+        count, image_size, shadow_size, name = spec
+        return TileArena(count, image_size, shadow_size, name)
+
+    def put(self, slot, image, shadow):
+        offset = slot * self.slot_bytes
+        self.shm.buf[offset:offset + self.image_bytes] = image.convert("RGBA").tobytes()
+        offset += self.image_bytes
+        self.shm.buf[offset:offset + self.shadow_bytes] = shadow.convert("RGBA").tobytes()
+
+    def image(self, slot):
+        # These are views on the shared memory, not copies
+        offset = slot * self.slot_bytes
+        return Image.frombuffer("RGBA", self.image_size, self.shm.buf[offset:offset + self.image_bytes], "raw", "RGBA", 0, 1)
+
+    def shadow(self, slot):
+        offset = slot * self.slot_bytes + self.image_bytes
+        return Image.frombuffer("RGBA", self.shadow_size, self.shm.buf[offset:offset + self.shadow_bytes], "raw", "RGBA", 0, 1)
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError:
+            # Someone still has a view on the memory, it'll go away with them
+            pass
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import os, struct
+
+# Rendered tiles are stored here, named by the hash of what went into them
+CACHE_DIR = os.path.join("cache", "tiles")
+# Once the cache is bigger than this, the least recently used tiles are removed
+MAX_BYTES = 256 * 1024 * 1024
+
+class TileCache:
+    # A simple on disk cache of the encoded image and shadow for a tile.  Each
+    # entry is one file, the length of the image bytes, the image bytes, and
+    # then the shadow bytes.  The file's mtime is bumped on every hit so the
+    # oldest files are the least recently used.
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _fn(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".bin")
+
+    def get(self, key):
+        fn = self._fn(key)
+        try:
+            with open(fn, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        os.utime(fn)
+        self.hits += 1
+        image_len, = struct.unpack("<I", raw[:4])
+        return raw[4:4 + image_len], raw[4 + image_len:]
+
+    def put(self, key, image_bits, shadow_bits):
+        fn = self._fn(key)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        temp_fn = fn + f".{os.getpid()}.tmp"
+        with open(temp_fn, "wb") as f:
+            f.write(struct.pack("<I", len(image_bits)))
+            f.write(image_bits)
+            f.write(shadow_bits)
+        os.replace(temp_fn, fn)
+
+    def evict(self):
+        # Remove the least recently used entries till we're under the size limit
+        if not os.path.isdir(self.cache_dir):
+            return 0
+        entries = []
+        for dirname, dirnames, filenames in os.walk(self.cache_dir):
+            for fn in filenames:
+                fn = os.path.join(dirname, fn)
+                stat = os.stat(fn)
+                entries.append((stat.st_mtime, stat.st_size, fn))
+        total = sum(x[1] for x in entries)
+        removed = 0
+        for _, size, fn in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.unlink(fn)
+            total -= size
+            removed += 1
+        return removed
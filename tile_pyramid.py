@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+from PIL import Image
+import hashlib, json, math, os
+
+TILE_SIZE = 256
+# Bump this if the way tiles are drawn changes, to redraw every tile
+PYRAMID_VERSION = 1
+
+def level_sizes(width, height):
+    # The size of each Deep Zoom level, level 0 is a single pixel and
+    # each level after that doubles till the last one is the full image
+    levels = int(math.ceil(math.log2(max(width, height)))) + 1
+    return [
+        (int(math.ceil(width / 2 ** (levels - 1 - i))), int(math.ceil(height / 2 ** (levels - 1 - i))))
+        for i in range(levels)
+    ]
+
+def tile_grid(size, tile_size):
+    # All of the tiles for one level, as (col, row, left, top, right, bottom)
+    width, height = size
+    for row in range(int(math.ceil(height / tile_size))):
+        for col in range(int(math.ceil(width / tile_size))):
+            left, top = col * tile_size, row * tile_size
+            yield col, row, left, top, min(width, left + tile_size), min(height, top + tile_size)
+
+def write_pyramid(layout, fn, tile_size=TILE_SIZE):
+    # Write the layout out as a Deep Zoom image, fn is the .dzi file, and
+    # the tiles go in a "<name>_files" directory next to it along with a
+    # manifest of the hash of each tile.  If the manifest is there from a
+    # previous run, only the tiles that changed are drawn again.
+    tiles_dn = os.path.splitext(fn)[0] + "_files"
+    manifest_fn = os.path.join(tiles_dn, "manifest.json")
+
+    old = {}
+    if os.path.isfile(manifest_fn):
+        with open(manifest_fn) as f:
+            manifest = json.load(f)
+        if manifest.get("version") == PYRAMID_VERSION and manifest.get("tile_size") == tile_size:
+            old = manifest["tiles"]
+
+    width, height = layout.size()
+    sizes = level_sizes(width, height)
+    make_fn = lambda level, col, row: os.path.join(tiles_dn, str(level), f"{col}_{row}.png")
+
+    # Work from the full sized level down, so each smaller level can be
+    # built from the four tiles above it
+    tiles = {}
+    drawn = 0
+    for level in reversed(range(len(sizes))):
+        os.makedirs(os.path.join(tiles_dn, str(level)), exist_ok=True)
+        for col, row, left, top, right, bottom in tile_grid(sizes[level], tile_size):
+            if level == len(sizes) - 1:
+                # The hash is everything that draws in this tile
+                children = None
+                parts = [
+                    obj.signature(layer)
+                    for layer in layout.LAYERS
+                    for obj in layout.objects_in(layer, left, top, right, bottom)
+                ]
+            else:
+                children = [
+                    (col * 2 + x, row * 2 + y) for y in range(2) for x in range(2)
+                    if f"{level + 1}/{col * 2 + x}_{row * 2 + y}" in tiles
+                ]
+                parts = [tiles[f"{level + 1}/{x}_{y}"] for x, y in children]
+            key = f"{level}/{col}_{row}"
+            tiles[key] = hashlib.sha1(json.dumps([len(sizes), left, top, right, bottom, parts]).encode("utf-8")).hexdigest()
+
+            tile_fn = make_fn(level, col, row)
+            if old.get(key) == tiles[key] and os.path.isfile(tile_fn):
+                continue
+
+            if children is None:
+                im = layout.draw_region(left, top, right, bottom)
+            else:
+                # Shrink the (up to) four tiles from the level above
+                child_w, child_h = sizes[level + 1]
+                im = Image.new('RGB', (min(child_w, right * 2) - left * 2, min(child_h, bottom * 2) - top * 2), (255, 255, 255))
+                for x, y in children:
+                    with Image.open(make_fn(level + 1, x, y)) as child:
+                        im.paste(child, ((x - col * 2) * tile_size, (y - row * 2) * tile_size))
+                im = im.resize((right - left, bottom - top), Image.Resampling.LANCZOS)
+            im.save(tile_fn)
+            im.close()
+            drawn += 1
+
+    # Remove any tiles that aren't part of the pyramid anymore
+    for key in old:
+        if key not in tiles:
+            level, name = key.split("/")
+            tile_fn = os.path.join(tiles_dn, level, name + ".png")
+            if os.path.isfile(tile_fn):
+                os.unlink(tile_fn)
+
+    with open(manifest_fn, "wt", newline="", encoding="utf-8") as f:
+        json.dump({
+            "version": PYRAMID_VERSION, "width": width, "height": height,
+            "tile_size": tile_size, "levels": len(sizes), "format": "png", "tiles": tiles,
+        }, f, indent=4, sort_keys=True)
+        f.write("\n")
+
+    with open(fn, "wt", newline="", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="png" Overlap="0" TileSize="{tile_size}">\n')
+        f.write(f'    <Size Width="{width}" Height="{height}"/>\n')
+        f.write('</Image>\n')
+
+    print(f"Drew {drawn:,} of {len(tiles):,} pyramid tiles")